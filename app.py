@@ -1,34 +1,134 @@
 import os
+import asyncio
+import hashlib
+import functools
 import gradio as gr
 from podcast import generate_podcast
-from uuid import uuid4
+from pdf_reader import pdf_digest
+from scheduler import JobScheduler, QueueFullError
+from run_store import default_run_store
+from decoder import ffmpeg_available
+import metrics
 
+STAGES = [
+    "queued", "parsing", "scratchpad", "dialogue+voice_clips", "voice_clips",
+    "joining", "done"
+]
 
-async def process_pdf(pdf_file, user_instruction):
+# Serve a compressed episode when ffmpeg can encode one (see `podcast_format`)
+PODCAST_FORMAT = os.getenv("PODCAST_FORMAT")
+
+
+@functools.lru_cache(maxsize=None)
+def podcast_format() -> str:
+    """
+    The format episodes are served in. Probing for ffmpeg loads pydub, so
+    it is done for the first job rather than on import.
+    """
+    if PODCAST_FORMAT is not None:
+        return PODCAST_FORMAT
+    return "mp3" if ffmpeg_available() else "wav"
+
+
+scheduler = JobScheduler(workers=int(os.getenv("PODCAST_WORKERS", 2)),
+                         max_queue=int(os.getenv("PODCAST_QUEUE_SIZE", 16)))
+
+
+async def run_job(pdf_path,
+                  output_dir,
+                  user_instruction,
+                  on_stage=None,
+                  on_output=None):
+    runs = default_run_store()
+    # The job keeps its run even if every request waiting on it goes away
+    run = os.path.basename(output_dir)
+    runs.acquire(run)
+    try:
+        output_format = await asyncio.to_thread(podcast_format)
+        return await generate_podcast(pdf_path,
+                                      output_dir,
+                                      user_instruction,
+                                      stream=True,
+                                      on_stage=on_stage,
+                                      on_audio=on_output,
+                                      resume=True,
+                                      output_format=output_format)
+    finally:
+        runs.release(run)
+
+
+async def process_pdf(pdf_file, user_instruction, progress=gr.Progress()):
     pdf_path = pdf_file.name
-    uuid = str(uuid4())
-    output_dir = f"output_{uuid}"
-    os.makedirs(output_dir, exist_ok=True)
-
-    await generate_podcast(pdf_path, output_dir, user_instruction)
-
-    output_file = os.path.join(output_dir, "full_podcast.wav")
-    return output_file
-
-
-iface = gr.Interface(
-    fn=process_pdf,
-    inputs=[
-        gr.File(label="Upload PDF", file_types=[".pdf"]),
-        gr.Textbox(label="User Instructions",
-                   placeholder=
-                   "Enter specific areas or instructions for the podcast...")
-    ],
-    outputs=gr.Audio(label="Generated Podcast"),
-    title="PDF2Pod: PDF to Podcast Generator",
-    description=
-    "Upload a PDF file and provide instructions to generate a podcast-style audio file.",
-)
+    # Identical PDF + instruction collapse onto one job and output directory
+    digest = await asyncio.to_thread(pdf_digest, pdf_path)
+    key = hashlib.sha256(
+        f"{digest}\n{user_instruction}".encode("utf-8")).hexdigest()
+    runs = default_run_store()
+    runs.start()
+    run = f"output_{key[:32]}"
+    # Held while this request still streams files from the run
+    output_dir = runs.acquire(run)
+    try:
+        async for update in stream_job(key, pdf_path, output_dir,
+                                       user_instruction, progress):
+            yield update
+    finally:
+        runs.release(run)
+
+
+async def stream_job(key, pdf_path, output_dir, user_instruction, progress):
+    try:
+        job = scheduler.submit(key, run_job, pdf_path, output_dir,
+                               user_instruction)
+    except QueueFullError:
+        raise gr.Error("The server is busy, please try again in a minute.")
+
+    # Stream finished chunks to the player while the rest is rendered
+    result = asyncio.ensure_future(scheduler.wait(job))
+    sent = 0
+    while not result.done():
+        while sent < len(job.outputs):
+            if os.path.exists(job.outputs[sent]):
+                yield job.outputs[sent], gr.skip()
+            sent += 1
+        position = scheduler.position(job)
+        if position is not None:
+            desc = f"Queued ({position} ahead, {scheduler.queue_depth()} waiting)"
+        else:
+            desc = job.stage
+        stage = STAGES.index(job.stage) if job.stage in STAGES else 0
+        progress(stage / (len(STAGES) - 1), desc=desc)
+        await asyncio.wait([result], timeout=0.5)
+    # Chunks are deleted once the episode is finished, which then plays in
+    # full from the final output
+    for chunk in job.outputs[sent:]:
+        if os.path.exists(chunk):
+            yield chunk, gr.skip()
+    yield gr.skip(), result.result()
+
+
+def build_interface() -> gr.Interface:
+    # Built on launch only: PDF extraction workers import this script too
+    return gr.Interface(
+        fn=process_pdf,
+        inputs=[
+            gr.File(label="Upload PDF", file_types=[".pdf"]),
+            gr.Textbox(label="User Instructions",
+                       placeholder=
+                       "Enter specific areas or instructions for the podcast...")
+        ],
+        outputs=[
+            gr.Audio(label="Live Playback", streaming=True, autoplay=True),
+            gr.Audio(label="Generated Podcast")
+        ],
+        title="PDF2Pod: PDF to Podcast Generator",
+        description=
+        "Upload a PDF file and provide instructions to generate a podcast-style audio file.",
+        concurrency_limit=None,
+    )
+
 
 if __name__ == "__main__":
-    iface.launch()
+    if metrics.recorder.enabled and metrics.METRICS_PORT:
+        metrics.recorder.serve(int(metrics.METRICS_PORT))
+    build_interface().launch()
@@ -0,0 +1,166 @@
+"""
+Convert every PDF in a directory into a podcast.
+
+Documents run concurrently but share one OpenAI and one ElevenLabs request
+budget. On both, requests from documents further along the pipeline go
+first, so finished dialogues are voiced before new documents start theirs.
+A summary of per-document timings and failures is written to
+`<output_dir>/summary.json`.
+
+    python batch.py papers/ podcasts/ --jobs 4 --format mp3
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from typing import Any, Dict, List, Optional
+from concurrency import AdaptiveLimiter, prioritize
+from llm import LLM_MAX_CONCURRENCY
+from podcast import generate_podcast
+
+
+async def convert(pdf_path: str,
+                  output_dir: str,
+                  rank: int,
+                  tts_limiter: AdaptiveLimiter,
+                  user_instruction: str = "",
+                  **kwargs) -> Dict[str, Any]:
+    """Run one document and describe how it went."""
+    # Earlier documents win ties on the shared limiters
+    prioritize(0, rank)
+    stages = {}
+    current = {"stage": None, "since": time.perf_counter()}
+    start = current["since"]
+
+    def on_stage(stage):
+        now = time.perf_counter()
+        if current["stage"] is not None:
+            stages[current["stage"]] = stages.get(current["stage"],
+                                                  0.0) + now - current["since"]
+        current.update(stage=stage, since=now)
+
+    result = {"pdf": pdf_path, "output": None, "status": "ok", "error": None}
+    try:
+        result["output"] = await generate_podcast(pdf_path,
+                                                  output_dir,
+                                                  user_instruction,
+                                                  on_stage=on_stage,
+                                                  tts_limiter=tts_limiter,
+                                                  **kwargs)
+    except Exception as e:
+        result.update(status="failed", error=repr(e))
+    on_stage(None)
+    result.update(seconds=round(time.perf_counter() - start, 3),
+                  stages={name: round(s, 3)
+                          for name, s in stages.items()})
+    return result
+
+
+async def run_batch(pdfs: List[str],
+                    output_root: str,
+                    jobs: int = 4,
+                    llm_concurrency: int = LLM_MAX_CONCURRENCY,
+                    tts_min_concurrency: Optional[int] = None,
+                    tts_max_concurrency: Optional[int] = None,
+                    on_result: Optional[Any] = None,
+                    **kwargs) -> List[Dict[str, Any]]:
+    """
+    Convert `pdfs` with up to `jobs` documents in flight, each into its own
+    directory under `output_root`. Returns one result per document, in
+    input order. The TTS concurrency bounds default to `TTS_MIN_CONCURRENCY`
+    and `TTS_MAX_CONCURRENCY`.
+    """
+    from dialogue import openai_wrapper
+    from voiceover import TTS_MIN_CONCURRENCY, TTS_MAX_CONCURRENCY
+    openai_wrapper.limiter = AdaptiveLimiter(1,
+                                             llm_concurrency,
+                                             initial_limit=llm_concurrency)
+    tts_limiter = AdaptiveLimiter(tts_min_concurrency or TTS_MIN_CONCURRENCY,
+                                  tts_max_concurrency or TTS_MAX_CONCURRENCY,
+                                  initial_limit=2)
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def run(rank, pdf_path):
+        name = os.path.splitext(os.path.basename(pdf_path))[0]
+        async with semaphore:
+            result = await convert(pdf_path, os.path.join(output_root, name),
+                                   rank, tts_limiter, **kwargs)
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    try:
+        return await asyncio.gather(
+            *[run(rank, pdf) for rank, pdf in enumerate(pdfs)])
+    finally:
+        openai_wrapper.limiter = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("input_dir", help="Directory of PDFs to convert")
+    parser.add_argument("output_dir", help="One subdirectory per PDF goes here")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Documents in flight at once")
+    parser.add_argument("--instruction", default="",
+                        help="User instruction applied to every document")
+    parser.add_argument("--format", default="wav",
+                        choices=["wav", "mp3", "opus"])
+    parser.add_argument("--llm-concurrency", type=int,
+                        default=LLM_MAX_CONCURRENCY)
+    parser.add_argument("--tts-concurrency", type=int,
+                        help="Default: TTS_MAX_CONCURRENCY")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="Finish each dialogue before voicing it")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore checkpoints of earlier runs")
+    args = parser.parse_args()
+
+    pdfs = sorted(
+        os.path.join(args.input_dir, name)
+        for name in os.listdir(args.input_dir)
+        if name.lower().endswith(".pdf"))
+    if not pdfs:
+        parser.error(f"No PDFs in {args.input_dir}")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    def on_result(result):
+        print(f"[{result['status']}] {result['pdf']} "
+              f"({result['seconds']:.1f}s) {result['error'] or ''}",
+              file=sys.stderr)
+
+    # Pipeline output is verbose; keep it in a log next to the results
+    log_path = os.path.join(args.output_dir, "batch.log")
+    start = time.perf_counter()
+    with open(log_path, "a") as log, contextlib.redirect_stdout(log):
+        results = asyncio.run(
+            run_batch(pdfs,
+                      args.output_dir,
+                      jobs=args.jobs,
+                      llm_concurrency=args.llm_concurrency,
+                      tts_max_concurrency=args.tts_concurrency,
+                      on_result=on_result,
+                      user_instruction=args.instruction,
+                      stream=not args.no_stream,
+                      resume=not args.restart,
+                      output_format=args.format))
+    summary = {
+        "seconds": round(time.perf_counter() - start, 3),
+        "documents": len(results),
+        "failed": sum(1 for result in results if result["status"] != "ok"),
+        "results": results,
+    }
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"{summary['documents'] - summary['failed']}/{summary['documents']} "
+          f"documents converted in {summary['seconds']:.1f}s, see "
+          f"{os.path.join(args.output_dir, 'summary.json')}")
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Startup benchmark for the headless entry points.
+
+Imports each module in a fresh interpreter, without an OpenAI API key, and
+reports the median import time, how many modules it loaded and which heavy
+dependencies came with it. Fails if an import prints anything, if a headless
+entry point loads a heavy dependency, or if it takes longer than the budget.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --budget-ms 250 --runs 10
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules the CLI and library users import before any work starts
+HEADLESS = ["podcast", "cli", "batch"]
+MODULES = HEADLESS + ["llm", "dialogue", "voiceover", "app"]
+HEAVY = ["openai", "gradio", "numpy", "pydub", "tqdm", "httpx", "pydantic"]
+
+_CHILD = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": len(sys.modules),
+                  "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module: str) -> dict:
+    env = {key: value for key, value in os.environ.items()
+           if key != "OPENAI_API_KEY"}
+    result = subprocess.run(
+        [sys.executable, "-c", _CHILD.format(module=module, heavy=HEAVY)],
+        cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    *printed, last = result.stdout.strip().splitlines()
+    return {**json.loads(last), "printed": len(printed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=300,
+                        help="Import time allowed for headless entry points")
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    print(f"{'module':>10} {'import (ms)':>12} {'modules':>8}  heavy")
+    results, failures = {}, []
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.runs)]
+        errors = [run["error"] for run in runs if "error" in run]
+        if errors:
+            print(f"{module:>10} {'error':>12}  {errors[0]}")
+            if module in HEADLESS:
+                failures.append(f"{module}: {errors[0]}")
+            continue
+        result = {
+            "ms": statistics.median(run["seconds"] for run in runs) * 1000,
+            "modules": runs[0]["modules"],
+            "heavy": runs[0]["heavy"],
+            "printed": runs[0]["printed"],
+        }
+        results[module] = result
+        print(f"{module:>10} {result['ms']:>12.1f} {result['modules']:>8}  "
+              f"{', '.join(result['heavy']) or '-'}")
+        if result["printed"]:
+            failures.append(f"{module}: printed {result['printed']} lines "
+                            "on import")
+        if module in HEADLESS:
+            if result["heavy"]:
+                failures.append(f"{module}: loads {', '.join(result['heavy'])}")
+            if result["ms"] > args.budget_ms:
+                failures.append(f"{module}: {result['ms']:.0f} ms > "
+                                f"{args.budget_ms:.0f} ms budget")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "failures": failures}, f, indent=2)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Scaling benchmark for the episode renderer.
+
+Compares ``timeline.render_timeline`` with the append/overlay chain it
+replaced on synthetic clips and checks both produce identical samples.
+With ``--memory``, compares the peak memory of rendering the whole episode
+in memory with streaming it to a WAV file turn by turn.
+
+    python benchmarks/bench_join.py --turns 10 50 100 200
+    python benchmarks/bench_join.py --memory --turns 100 500
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from pydub import AudioSegment
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timeline import render_timeline  # noqa: E402
+from voiceover import render_to_file  # noqa: E402
+
+
+def make_clip(rng: random.Random, frame_rate: int = 44100,
+              channels: int = 1) -> AudioSegment:
+    duration_ms = rng.randint(300, 12000) + rng.random()
+    frames = int(frame_rate * duration_ms / 1000)
+    samples = np.random.default_rng(rng.randint(0, 2**32)).integers(
+        -20000, 20000, size=frames * channels, dtype=np.int16)
+    return AudioSegment(data=samples.tobytes(),
+                        sample_width=2,
+                        frame_rate=frame_rate,
+                        channels=channels)
+
+
+def iter_turns(count: int, seed: int = 0, **kwargs):
+    rng = random.Random(seed)
+    for _ in range(count):
+        overlaps = [
+            make_clip(rng, **kwargs)
+            for _ in range(rng.choice([0, 0, 0, 1, 1, 2]))
+        ]
+        yield make_clip(rng, **kwargs), overlaps
+
+
+def make_turns(count: int, seed: int = 0, **kwargs):
+    return list(iter_turns(count, seed, **kwargs))
+
+
+def legacy_join(turns) -> AudioSegment:
+    """The original ``join_audio_clips`` loop, minus the file loading."""
+    output_audio = AudioSegment.silent(duration=0)
+    for clip, overlaps in turns:
+        for overlap_clip in overlaps:
+            overlap_start_time = max(0, len(clip) - 850)
+            clip = clip.overlay(overlap_clip, position=overlap_start_time)
+            if len(overlap_clip) > 850:
+                remaining_overlap = overlap_clip[850:]
+                clip = clip.append(remaining_overlap, crossfade=0)
+        if len(clip) < 10 or len(output_audio) < 10:
+            crossfade_duration = 0
+        else:
+            crossfade_duration = min(10, len(clip) // 2,
+                                     len(output_audio) // 2)
+        output_audio = output_audio.append(clip, crossfade=crossfade_duration)
+    return output_audio
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_mb(fn, *args) -> float:
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024**2
+    finally:
+        tracemalloc.stop()
+
+
+def memory(counts):
+    print(f"{'turns':>6} {'audio (s)':>10} {'in memory (MB)':>15} "
+          f"{'streaming (MB)':>15}")
+    with tempfile.TemporaryDirectory() as workdir:
+        output_file = os.path.join(workdir, "episode.wav")
+        for count in counts:
+            # Both sides decode clips lazily; only the renderer differs
+            in_memory = peak_mb(
+                lambda: render_timeline(list(iter_turns(count))).export(
+                    output_file, format="wav"))
+            streaming = peak_mb(
+                lambda: render_to_file(iter_turns(count), output_file))
+            seconds = os.path.getsize(output_file) / (44100 * 2)
+            print(f"{count:>6} {seconds:>10.1f} {in_memory:>15.1f} "
+                  f"{streaming:>15.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, nargs="+",
+                        default=[10, 25, 50, 100, 200])
+    parser.add_argument("--skip-legacy", action="store_true",
+                        help="Only time the timeline renderer")
+    parser.add_argument("--memory", action="store_true",
+                        help="Compare peak memory with streaming to a file")
+    args = parser.parse_args()
+    if args.memory:
+        memory(args.turns)
+        return
+
+    print(f"{'turns':>6} {'audio (s)':>10} {'timeline (s)':>13} "
+          f"{'legacy (s)':>11} {'speedup':>8} {'identical':>10}")
+    for count in args.turns:
+        turns = make_turns(count)
+        rendered, fast = timed(render_timeline, turns)
+        if args.skip_legacy:
+            print(f"{count:>6} {len(rendered) / 1000:>10.1f} {fast:>13.3f}")
+            continue
+        reference, slow = timed(legacy_join, turns)
+        identical = (rendered.raw_data == reference.raw_data
+                     and rendered.frame_rate == reference.frame_rate
+                     and rendered.channels == reference.channels)
+        print(f"{count:>6} {len(rendered) / 1000:>10.1f} {fast:>13.3f} "
+              f"{slow:>11.3f} {slow / fast:>7.1f}x {str(identical):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Offline end-to-end benchmark of `generate_podcast`.
+
+Each scenario runs the full pipeline in a fresh subprocess against local
+stand-ins for the OpenAI chat-completions and ElevenLabs text-to-speech
+endpoints (see `stubs.py`) with cold caches, and reports wall time,
+time-to-first-clip, time until the first chunk of mixed audio is playable,
+peak RSS and the per-stage breakdown from the run report.
+
+    python benchmarks/bench_pipeline.py --scenarios small-10 large-100 --stream
+    python benchmarks/bench_pipeline.py --json results.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import resource
+import contextlib
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from stubs import ChatStub, TTSStub  # noqa: E402
+
+# name: (pdf pages, dialogue turns)
+SCENARIOS = {
+    "small-10": (5, 10),
+    "small-50": (5, 50),
+    "large-100": (300, 100),
+    "large-300": (300, 300),
+}
+RESULT_MARKER = "BENCH_RESULT "
+
+
+def make_pdf(path: str, pages: int, lines_per_page: int = 40):
+    """Write a minimal text PDF with `pages` pages of filler text."""
+    font = 3 + 2 * pages
+    objects = [(1, "<< /Type /Catalog /Pages 2 0 R >>")]
+    kids = []
+    body = []
+    number = 3
+    for page in range(pages):
+        text = "BT /F1 10 Tf 40 800 Td 12 TL " + " ".join(
+            f"(Page {page + 1} line {line}: memory paging context windows "
+            f"and agents) '" for line in range(lines_per_page)) + " ET"
+        kids.append(f"{number} 0 R")
+        body.append(
+            (number,
+             f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+             f"/Contents {number + 1} 0 R /Resources << /Font << /F1 {font} 0 R >> >> >>"
+             ))
+        body.append((number + 1,
+                     f"<< /Length {len(text)} >>\nstream\n{text}\nendstream"))
+        number += 2
+    objects.append(
+        (2, f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"))
+    objects += body
+    objects.append(
+        (font, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"))
+
+    output = b"%PDF-1.4\n"
+    offsets = {}
+    for number, content in objects:
+        offsets[number] = len(output)
+        output += f"{number} 0 obj\n{content}\nendobj\n".encode()
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for number in range(1, len(objects) + 1):
+        output += f"{offsets[number]:010d} 00000 n \n".encode()
+    output += (f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+               f"startxref\n{xref}\n%%EOF\n").encode()
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def first_clip_seconds(report: dict):
+    root = report["trace"]
+    ends = []
+
+    def walk(span):
+        if span["name"] == "tts.clip":
+            ends.append(span["started_at"] + span["seconds"])
+        for child in span["children"]:
+            walk(child)
+
+    walk(root)
+    return min(ends) - root["started_at"] if ends else None
+
+
+def run_child(args):
+    """Run one pipeline in this process and print its measurements."""
+    from podcast import generate_podcast
+
+    start = time.perf_counter()
+    chunks = []
+
+    def on_audio(path):
+        chunks.append(time.perf_counter() - start)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(
+            generate_podcast(args.pdf,
+                             args.output,
+                             "",
+                             stream=args.stream,
+                             on_audio=on_audio))
+    wall = time.perf_counter() - start
+    with open(os.path.join(args.output, "run_report.json")) as f:
+        report = json.load(f)
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+    print(RESULT_MARKER + json.dumps({
+        "wall_seconds": wall,
+        "first_clip_seconds": first_clip_seconds(report),
+        "first_audio_seconds": chunks[0] if chunks else None,
+        "peak_rss_mb": peak_mb,
+        "stages": report["stages"],
+        "totals": report["totals"],
+    }))
+
+
+def run_scenario(name: str, stream: bool, args, workdir: str) -> dict:
+    pages, turns = SCENARIOS[name]
+    pdf = os.path.join(workdir, f"{pages}_pages.pdf")
+    if not os.path.exists(pdf):
+        make_pdf(pdf, pages)
+    chat = ChatStub(turns=turns,
+                    latency=args.chat_latency,
+                    tokens_per_second=args.tokens_per_second,
+                    throttle_rate=args.throttle_rate,
+                    truncate_rate=args.truncate_rate)
+    tts = TTSStub(latency=args.tts_latency,
+                  latency_per_char=args.tts_latency_per_char,
+                  capacity=args.tts_capacity,
+                  throttle_rate=args.throttle_rate,
+                  audio_seconds=args.audio_seconds)
+    run_dir = tempfile.mkdtemp(dir=workdir)
+    env = dict(os.environ,
+               OPENAI_API_KEY="stub",
+               OPENAI_BASE_URL=chat.start(),
+               ELEVENLABS_API_KEY="stub",
+               ELEVENLABS_API_URL=tts.start(),
+               CLIP_CACHE_DIR=os.path.join(run_dir, "clips"),
+               TEXT_CACHE_DIR=os.path.join(run_dir, "text"),
+               LLM_CACHE="0",
+               PDF2POD_METRICS="1")
+    command = [
+        sys.executable,
+        os.path.abspath(__file__), "--child", "--pdf", pdf, "--output",
+        os.path.join(run_dir, "output")
+    ] + (["--stream"] if stream else [])
+    try:
+        completed = subprocess.run(command,
+                                   env=env,
+                                   cwd=run_dir,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   text=True)
+    finally:
+        chat.stop()
+        tts.stop()
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            result = json.loads(line[len(RESULT_MARKER):])
+            break
+    else:
+        raise RuntimeError(f"Scenario {name} failed:\n{completed.stderr}")
+    result.update(scenario=name,
+                  stream=stream,
+                  pages=pages,
+                  turns=turns,
+                  chat_429=chat.counts["throttled"],
+                  chat_truncated=chat.counts["truncated"],
+                  tts_requests=tts.counts["requests"],
+                  tts_429=tts.counts["throttled"])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scenarios",
+                        nargs="+",
+                        choices=sorted(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="Only run the streaming pipeline")
+    parser.add_argument("--no-stream",
+                        action="store_true",
+                        help="Only run the batch pipeline")
+    parser.add_argument("--chat-latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=2000)
+    parser.add_argument("--tts-latency", type=float, default=0.2)
+    parser.add_argument("--tts-latency-per-char", type=float, default=0.0005)
+    parser.add_argument("--tts-capacity", type=int, default=8)
+    parser.add_argument("--throttle-rate", type=float, default=0.02)
+    parser.add_argument("--audio-seconds", type=float, default=3.0)
+    parser.add_argument("--truncate-rate", type=float, default=0.0,
+                        help="Share of dialogue responses cut off mid-way")
+    parser.add_argument("--json", help="Also write results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--pdf", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    modes = [True, False]
+    if args.stream:
+        modes = [True]
+    elif args.no_stream:
+        modes = [False]
+
+    results = []
+    print(f"{'scenario':>10} {'stream':>6} {'wall (s)':>9} {'first clip':>11} "
+          f"{'first audio':>12} {'rss (MB)':>9} {'429s':>5}  stages")
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenarios:
+            for stream in modes:
+                result = run_scenario(name, stream, args, workdir)
+                results.append(result)
+                first = result["first_clip_seconds"]
+                audio = result["first_audio_seconds"]
+                stages = ", ".join(
+                    f"{stage}={seconds:.2f}"
+                    for stage, seconds in result["stages"].items()
+                    if stage in ("parse_pdf", "scratchpad", "dialogue_call",
+                                 "llm.stream", "voice_clips",
+                                 "dialogue+voice_clips", "join"))
+                print(f"{name:>10} {str(stream):>6} "
+                      f"{result['wall_seconds']:>9.2f} "
+                      f"{first if first is not None else float('nan'):>11.2f} "
+                      f"{audio if audio is not None else float('nan'):>12.2f} "
+                      f"{result['peak_rss_mb']:>9.1f} "
+                      f"{result['chat_429'] + result['tts_429']:>5}  {stages}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
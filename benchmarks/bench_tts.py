@@ -0,0 +1,116 @@
+"""
+TTS concurrency benchmark against the local ElevenLabs stub.
+
+Runs `generate_voice_clips` with a fixed limit and with the adaptive
+limiter while the stub injects latency and throttling, then repeats the
+adaptive run to show clip store hits. With `--split`, it then compares
+synthesizing long lines whole and as sentences in parallel at a fixed limit
+(stitching needs ffmpeg).
+
+    python benchmarks/bench_tts.py --clips 60 --capacity 6 --latency 0.3
+    python benchmarks/bench_tts.py --clips 8 --latency-per-char 0.01 --split
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The stub ignores the key, but the request header needs one
+os.environ.setdefault("ELEVENLABS_API_KEY", "stub")
+
+import voiceover  # noqa: E402
+from concurrency import AdaptiveLimiter  # noqa: E402
+from clip_store import ClipStore  # noqa: E402
+from stubs import TTSStub  # noqa: E402
+
+
+def make_dialogue(count: int):
+    # Sentences of eight words, so long lines can be split
+    return [{
+        "speaker": f"Speaker{ix % 3}",
+        "text": f"Line {ix}: " + " ".join(
+            "words" if (word + 1) % 8 else "words."
+            for word in range(10 + ix * 7 % 40)),
+        "speaker_voice_id": "stub-voice"
+    } for ix in range(count)]
+
+
+async def run(args,
+              min_limit: int,
+              max_limit: int,
+              store: ClipStore,
+              split: bool = False):
+    stub = TTSStub(latency=args.latency,
+                   latency_per_char=args.latency_per_char,
+                   capacity=args.capacity,
+                   retry_after=args.retry_after,
+                   error_rate=args.error_rate,
+                   audio_seconds=args.audio_seconds)
+    voiceover.ELEVEN_LABS_API_URL = stub.start()
+    limiter = AdaptiveLimiter(min_limit, max_limit, initial_limit=2)
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            await voiceover.generate_voice_clips(make_dialogue(args.clips),
+                                                 output_dir,
+                                                 limiter=limiter,
+                                                 store=store,
+                                                 split_long_turns=split)
+            elapsed = time.perf_counter() - start
+            written = len(os.listdir(output_dir))
+    finally:
+        stub.stop()
+    return elapsed, written, stub, limiter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clips", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--latency-per-char", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=6)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--audio-seconds", type=float, default=1.0)
+    parser.add_argument("--split", action="store_true",
+                        help="Add a run that splits long lines")
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'wall (s)':>9} {'clips':>6} {'requests':>9} "
+          f"{'429':>5} {'5xx':>5} {'peak':>5} {'limit':>6} {'hits':>5}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        shared = ClipStore(os.path.join(cache_dir, "shared"))
+        modes = [
+            ("fixed-2", (2, 2), ClipStore(os.path.join(cache_dir, "fixed")),
+             False),
+            ("adaptive", (1, args.max_concurrency), shared, False),
+            ("cached", (1, args.max_concurrency), shared, False),
+        ]
+        if args.split:
+            # Same fixed limit with and without splitting. Earlier runs have
+            # timed requests, so the split length is derived from them.
+            limit = args.max_concurrency
+            for split in (False, True):
+                mode = f"{'split' if split else 'whole'}-{limit}"
+                modes.append((mode, (limit, limit),
+                              ClipStore(os.path.join(cache_dir, mode)), split))
+        for mode, limits, store, split in modes:
+            hits = store.hits
+            elapsed, written, stub, limiter = asyncio.run(
+                run(args, *limits, store, split))
+            print(f"{mode:>10} {elapsed:>9.2f} {written:>6} "
+                  f"{stub.counts['requests']:>9} "
+                  f"{stub.counts['throttled']:>5} "
+                  f"{stub.counts['errors']:>5} {stub.peak_in_flight:>5} "
+                  f"{limiter.limit:>6.1f} {store.hits - hits:>5}")
+        if args.split:
+            split_chars = voiceover.tts_latency.split_chars()
+            print(f"Split lines over {split_chars} characters")
+
+
+if __name__ == "__main__":
+    main()
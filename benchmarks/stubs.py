@@ -0,0 +1,352 @@
+"""
+Local stand-ins for the external APIs, for benchmarks that must not spend
+real credits.
+"""
+import io
+import json
+import time
+import wave
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+
+VOICE_IDS = [
+    "fNmfW5GlQ7PDakGkiTzs", "iP95p4xoKVk53GoZ742B", "cjVigY5qzO86Huf0OWal",
+    "cgSgspJ2msm6clMCkdW9"
+]
+SPEAKERS = ["Jessica", "Michael", "David", "Emily"]
+
+
+def wav_payload(seconds: float, frame_rate: int = 44100, seed: int = 0) -> bytes:
+    """A mono 16-bit WAV of quiet noise, readable by pydub without ffmpeg."""
+    rng = random.Random(seed)
+    frames = int(seconds * frame_rate)
+    samples = bytes(
+        rng.getrandbits(8) if ix % 2 == 0 else 0 for ix in range(frames * 2))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(frame_rate)
+        wav.writeframes(samples)
+    return buffer.getvalue()
+
+
+class _Stub:
+
+    def __init__(self, seed: int = 0):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self) -> str:
+        """Serve on a free local port and return the base URL."""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                stub.handle(self, json.loads(self.rfile.read(length) or b"{}"))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @staticmethod
+    def reply(handler: BaseHTTPRequestHandler,
+              status: int,
+              body: bytes = b"",
+              content_type: str = "application/json",
+              headers: Optional[dict] = None):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: dict):
+        raise NotImplementedError
+
+
+class TTSStub(_Stub):
+    """
+    Fake ElevenLabs `text-to-speech/{voice_id}` endpoint.
+
+    Each request sleeps `latency` seconds plus `latency_per_char` per input
+    character. Requests beyond `capacity` in flight, plus `throttle_rate` of
+    the rest, get a 429 with `Retry-After`; `error_rate` fail with a 503.
+    Responses are `audio_seconds` of WAV audio, or `payload_bytes` of noise
+    when `audio_seconds` is not set.
+    """
+
+    def __init__(self,
+                 latency: float = 0.2,
+                 latency_per_char: float = 0.0,
+                 capacity: int = 4,
+                 retry_after: float = 0.5,
+                 throttle_rate: float = 0.0,
+                 error_rate: float = 0.0,
+                 payload_bytes: int = 64 * 1024,
+                 audio_seconds: Optional[float] = None,
+                 seed: int = 0):
+        super().__init__(seed)
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        if audio_seconds is not None:
+            self.payload = wav_payload(audio_seconds, seed=seed)
+        else:
+            self.payload = random.Random(seed).randbytes(payload_bytes)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.counts = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0}
+
+    def start(self) -> str:
+        return f"{super().start()}/v1/text-to-speech"
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: dict):
+        with self.lock:
+            self.counts["requests"] += 1
+            if (self.in_flight >= self.capacity
+                    or self.random.random() < self.throttle_rate):
+                self.counts["throttled"] += 1
+                status = 429
+            elif self.random.random() < self.error_rate:
+                self.counts["errors"] += 1
+                status = 503
+            else:
+                status = 200
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight,
+                                          self.in_flight)
+        if status == 429:
+            self.reply(handler,
+                       429,
+                       headers={"Retry-After": str(self.retry_after)})
+            return
+        if status == 503:
+            self.reply(handler, 503)
+            return
+        try:
+            time.sleep(self.latency +
+                       self.latency_per_char * len(body.get("text", "")))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.counts["ok"] += 1
+        self.reply(handler, 200, self.payload, "audio/mpeg")
+
+
+class ChatStub(_Stub):
+    """
+    Fake OpenAI `chat/completions` endpoint answering the tool calls the
+    pipeline makes: scratchpad ideas (and their merge) and a dialogue of
+    `turns` turns.
+
+    Each request waits `latency` seconds, then produces its arguments at
+    `tokens_per_second` (about four characters per token), streamed as
+    server-sent events when requested. `throttle_rate` of requests get a 429
+    with `Retry-After`.
+    """
+
+    def __init__(self,
+                 turns: int = 20,
+                 latency: float = 0.5,
+                 tokens_per_second: float = 2000,
+                 throttle_rate: float = 0.0,
+                 retry_after: float = 0.2,
+                 overlap_every: int = 5,
+                 truncate_rate: float = 0.0,
+                 seed: int = 0):
+        super().__init__(seed)
+        self.turns = turns
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.overlap_every = overlap_every
+        self.truncate_rate = truncate_rate
+        self.counts = {
+            "requests": 0,
+            "throttled": 0,
+            "streamed": 0,
+            "truncated": 0
+        }
+
+    def start(self) -> str:
+        return f"{super().start()}/v1"
+
+    def scratchpad(self) -> dict:
+        return {
+            "about_the_document":
+            "A synthetic document used for offline benchmarks.",
+            "ideas": [{
+                "observation": f"Observation {ix}",
+                "idea": f"Idea {ix}",
+                "outline": f"Outline {ix}",
+                "key_insights": f"Insight {ix}"
+            } for ix in range(8)],
+            "speakers": [{
+                "speaker_name": name,
+                "speaker_voice_id": voice
+            } for name, voice in zip(SPEAKERS, VOICE_IDS)]
+        }
+
+    def dialogue(self) -> dict:
+        rng = random.Random(self.turns)
+        turns = []
+        for ix in range(self.turns):
+            speaker = ix % len(SPEAKERS)
+            turn = {
+                "speaker": SPEAKERS[speaker],
+                "text": f"Turn {ix}. " + " ".join(
+                    rng.choice(["memory", "paging", "context", "model",
+                                "agents", "latency", "tokens", "documents"])
+                    for _ in range(rng.randint(15, 60))) + ".",
+                "speaker_voice_id": VOICE_IDS[speaker]
+            }
+            if self.overlap_every and ix % self.overlap_every == 1:
+                other = (speaker + 1) % len(SPEAKERS)
+                turn["overlaps"] = [{
+                    "speaker": SPEAKERS[other],
+                    "text": f"Right, turn {ix}!",
+                    "speaker_voice_id": VOICE_IDS[other]
+                }]
+            turns.append(turn)
+        return {"dialogue": turns}
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: dict):
+        with self.lock:
+            self.counts["requests"] += 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.counts["throttled"] += 1
+        if throttled:
+            self.reply(handler,
+                       429,
+                       json.dumps({"error": {"message": "Rate limited"}
+                                   }).encode(),
+                       headers={"Retry-After": str(self.retry_after)})
+            return
+
+        choice = body.get("tool_choice")
+        if isinstance(choice, dict):
+            name = choice["function"]["name"]
+        else:
+            name = body["tools"][0]["function"]["name"]
+        truncated = False
+        if name == "generate_dialogue":
+            done = sum(
+                len(json.loads(message["content"])["dialogue"])
+                for message in body["messages"]
+                if message["role"] == "assistant")
+            arguments = json.dumps(
+                {"dialogue": self.dialogue()["dialogue"][done:]})
+            with self.lock:
+                truncated = self.random.random() < self.truncate_rate
+                if truncated:
+                    self.counts["truncated"] += 1
+                    arguments = arguments[:self.random.randint(
+                        1, len(arguments) - 1)]
+        else:
+            arguments = json.dumps(self.scratchpad())
+        prompt_tokens = sum(
+            len(str(m.get("content", ""))) for m in body["messages"]) // 4
+        completion_tokens = len(arguments) // 4
+        time.sleep(self.latency)
+
+        if body.get("stream"):
+            with self.lock:
+                self.counts["streamed"] += 1
+            self.stream(handler, body["model"], name, arguments)
+            return
+        time.sleep(completion_tokens / self.tokens_per_second)
+        response = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "finish_reason": "length" if truncated else "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [{
+                        "id": "call_stub",
+                        "type": "function",
+                        "function": {
+                            "name": name,
+                            "arguments": arguments
+                        }
+                    }]
+                }
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+        self.reply(handler, 200, json.dumps(response).encode())
+
+    def stream(self, handler: BaseHTTPRequestHandler, model: str, name: str,
+               arguments: str, chunk_chars: int = 64):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send(data: str):
+            event = f"data: {data}\n\n".encode()
+            handler.wfile.write(f"{len(event):x}\r\n".encode() + event +
+                                b"\r\n")
+            handler.wfile.flush()
+
+        for start in range(0, len(arguments), chunk_chars):
+            piece = arguments[start:start + chunk_chars]
+            time.sleep(len(piece) / 4 / self.tokens_per_second)
+            send(
+                json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": None,
+                        "delta": {
+                            "tool_calls": [{
+                                "index": 0,
+                                "id": "call_stub" if start == 0 else None,
+                                "type": "function" if start == 0 else None,
+                                "function": {
+                                    "name": name if start == 0 else None,
+                                    "arguments": piece
+                                }
+                            }]
+                        }
+                    }]
+                }))
+        send("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
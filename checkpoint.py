@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import hashlib
+from typing import Any, Dict, Optional
+from clip_store import atomic_write
+
+MANIFEST_FILE = "manifest.json"
+CHECKPOINT_DIR = "checkpoints"
+
+# Pipeline stages, in order. Each one is saved as `checkpoints/<stage>.json`.
+STAGES = ["text", "scratchpad", "dialogue", "clips", "render"]
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RunCheckpoint:
+    """
+    Stage checkpoints of one run, kept in its run directory.
+
+    `manifest.json` records the run's inputs, which decide whether
+    checkpoints can be reused, metadata that does not (such as where the
+    PDF was read from) and, per completed stage, the checkpoint file and
+    its SHA-256. A checkpoint only counts if its file
+    still matches that digest. Files are written atomically, so a crash
+    leaves either the old checkpoint or the new one.
+    """
+
+    def __init__(self, run_dir: str):
+        self.run_dir = run_dir
+        self.manifest_path = os.path.join(run_dir, MANIFEST_FILE)
+        os.makedirs(os.path.join(run_dir, CHECKPOINT_DIR), exist_ok=True)
+        self.manifest = {"inputs": {}, "metadata": {}, "stages": {}}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                print(f"Ignoring unreadable manifest: {self.manifest_path}")
+
+    @property
+    def inputs(self) -> Dict[str, Any]:
+        return self.manifest["inputs"]
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.manifest.setdefault("metadata", {})
+
+    def start(self,
+              inputs: Dict[str, Any],
+              resume: bool = True,
+              metadata: Optional[Dict[str, Any]] = None):
+        """
+        Begin a run with `inputs`. Completed stages are kept only when
+        resuming a run with the same inputs; `metadata` is recorded either
+        way.
+        """
+        if not resume or self.inputs != inputs:
+            self.manifest = {"inputs": inputs, "metadata": {}, "stages": {}}
+        self.metadata.update(metadata or {})
+        self._write_manifest()
+
+    def _path(self, stage: str) -> str:
+        return os.path.join(self.run_dir, CHECKPOINT_DIR, f"{stage}.json")
+
+    def _write_manifest(self):
+        atomic_write(self.manifest_path,
+                     json.dumps(self.manifest, indent=2).encode("utf-8"))
+
+    def load(self, stage: str, partial: bool = False) -> Optional[Any]:
+        """
+        The saved value of a completed stage, or None. With `partial`, also
+        return progress saved before the stage completed.
+        """
+        entry = self.manifest["stages"].get(stage)
+        if entry is None or not (partial or entry["complete"]):
+            return None
+        path = self._path(stage)
+        try:
+            if file_digest(path) != entry["sha256"]:
+                print(f"Checkpoint {stage} is corrupt, redoing it")
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, stage: str, value: Any, complete: bool = True):
+        """
+        Persist `value` for `stage`. Progress saved with `complete=False`
+        is only returned by `load(stage, partial=True)`.
+        """
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        atomic_write(self._path(stage), data)
+        self.manifest["stages"][stage] = {
+            "file": os.path.relpath(self._path(stage), self.run_dir),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "complete": complete,
+            "saved_at": time.time(),
+        }
+        self._write_manifest()
+
+    def completed(self):
+        return [
+            stage for stage in STAGES
+            if self.manifest["stages"].get(stage, {}).get("complete")
+        ]
@@ -0,0 +1,68 @@
+import tiktoken
+from functools import lru_cache
+from typing import List, Iterable, Iterator
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-4o") -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Older tiktoken releases do not know every model name
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def iter_sections(texts: Iterable[str],
+                  max_tokens: int,
+                  model: str = "gpt-4o") -> Iterator[str]:
+    """
+    Pack text into sections of at most `max_tokens` tokens, breaking at
+    paragraph and then line boundaries. Lines longer than the budget are cut
+    on token boundaries.
+
+    `texts` is consumed lazily (for example page by page from
+    `podcast.iter_pdf_text`), so sections are produced before the whole
+    document has been read.
+    """
+    encoding = get_encoding(model)
+    current = []
+    current_tokens = 0
+
+    def lines():
+        for text in texts:
+            yield from text.split("\n")
+
+    for line in lines():
+        tokens = encoding.encode(line, disallowed_special=())
+        if len(tokens) > max_tokens:
+            if current:
+                yield "\n".join(current)
+            current, current_tokens = [], 0
+            for start in range(0, len(tokens), max_tokens):
+                yield encoding.decode(tokens[start:start + max_tokens])
+            continue
+        # +1 for the newline joining it to the previous line
+        if current and current_tokens + len(tokens) + 1 > max_tokens:
+            yield "\n".join(current)
+            current, current_tokens = [], 0
+        # Prefer to start a section at a paragraph break
+        if not line.strip() and current_tokens > max_tokens // 2:
+            yield "\n".join(current)
+            current, current_tokens = [], 0
+            continue
+        current.append(line)
+        current_tokens += len(tokens) + (1 if len(current) > 1 else 0)
+    if current:
+        yield "\n".join(current)
+
+
+def split_text(text: str, max_tokens: int, model: str = "gpt-4o") -> List[str]:
+    """Split `text` into sections of at most `max_tokens` tokens."""
+    return [
+        section for section in iter_sections([text], max_tokens, model)
+        if section.strip()
+    ]
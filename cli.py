@@ -0,0 +1,77 @@
+"""
+Convert one PDF into a podcast without the web UI.
+
+Pipeline output goes to `<output_dir>/run.log`, stage changes to stderr and
+the path of the finished episode to stdout. Runs are checkpointed, so
+running the same command again picks up where an interrupted run stopped.
+
+    python cli.py paper.pdf podcasts/paper --format mp3
+    python cli.py --resume podcasts/paper
+"""
+import os
+import sys
+import asyncio
+import argparse
+import contextlib
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("pdf", nargs="?", help="PDF to convert")
+    parser.add_argument("output_dir",
+                        nargs="?",
+                        help="Run directory (default: named after the PDF)")
+    parser.add_argument("--resume", metavar="DIR",
+                        help="Finish the interrupted run in DIR")
+    parser.add_argument("--instruction", default="",
+                        help="Areas to focus on or other instructions")
+    parser.add_argument("--format", default="wav",
+                        choices=["wav", "mp3", "opus"])
+    parser.add_argument("--long-document", action="store_const", const=True,
+                        help="Summarise section by section regardless of "
+                        "length")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="Finish the dialogue before voicing it")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore checkpoints of earlier runs")
+    args = parser.parse_args()
+    if args.resume is None and args.pdf is None:
+        parser.error("Pass a PDF to convert or --resume DIR")
+
+    # Imported after parsing, so `--help` and usage errors return at once
+    from podcast import generate_podcast, resume_podcast
+
+    if args.resume is not None:
+        output_dir = args.resume
+        run = resume_podcast(output_dir,
+                             stream=not args.no_stream,
+                             output_format=args.format,
+                             on_stage=lambda stage: print(stage,
+                                                          file=sys.stderr))
+    else:
+        output_dir = args.output_dir or os.path.splitext(
+            os.path.basename(args.pdf))[0]
+        run = generate_podcast(
+            args.pdf,
+            output_dir,
+            args.instruction,
+            stream=not args.no_stream,
+            long_document=args.long_document,
+            on_stage=lambda stage: print(stage, file=sys.stderr),
+            resume=not args.restart,
+            output_format=args.format)
+
+    os.makedirs(output_dir, exist_ok=True)
+    log_path = os.path.join(output_dir, "run.log")
+    try:
+        with open(log_path, "a") as log, contextlib.redirect_stdout(log):
+            output_file = asyncio.run(run)
+    except Exception as e:
+        print(f"Failed: {e!r}, see {log_path}", file=sys.stderr)
+        sys.exit(1)
+    print(output_file)
+
+
+if __name__ == "__main__":
+    main()
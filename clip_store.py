@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from uuid import uuid4
+from collections import Counter, OrderedDict
+from typing import Dict, Any, Optional, AsyncIterator
+from decoder import StreamingDecoder, decode_in_pool
+
+CLIP_CACHE_DIR = os.getenv("CLIP_CACHE_DIR",
+                           os.path.join(".cache", "clips"))
+CLIP_CACHE_MAX_BYTES = int(os.getenv("CLIP_CACHE_MAX_BYTES", 2 * 1024**3))
+# Other processes sharing the store add clips too; re-measure it on disk at
+# least this often (seconds)
+CLIP_CACHE_RESCAN_INTERVAL = float(os.getenv("CLIP_CACHE_RESCAN_INTERVAL",
+                                             60))
+# Eviction frees space down to this share of the budget, so a full store is
+# not re-measured for every new clip
+EVICT_TO_FRACTION = 0.9
+
+CLIP_SUFFIX = ".mp3"
+# Decoded PCM kept next to the clip
+DECODED_SUFFIX = ".wav"
+TMP_SUFFIX = ".tmp"
+
+
+def clip_key(speaker_voice_id: str, data: Dict[str, Any]) -> str:
+    """
+    Content address of a clip: a hash of the voice and the full TTS request
+    body (text, model, voice settings, previous_text, format, seed).
+    """
+    payload = json.dumps({
+        "voice_id": speaker_voice_id,
+        **data
+    },
+                         sort_keys=True,
+                         ensure_ascii=False,
+                         separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def atomic_write(path: str, data: bytes):
+    """Write `data` to `path` so readers never see a partial file."""
+    tmp = f"{path}.{uuid4().hex}{TMP_SUFFIX}"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def link_or_copy(src: str, dst: str):
+    """Atomically place `src` at `dst`, hard-linking when possible."""
+    tmp = f"{dst}.{uuid4().hex}{TMP_SUFFIX}"
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ClipStore:
+    """
+    Content-addressed TTS clip cache shared across runs.
+
+    Clips live at `<root>/<key[:2]>/<key>.mp3`, optionally with their
+    decoded audio at `<key>.wav`. Both are written atomically, so an
+    interrupted write never turns into a cache hit. Least recently used
+    clips are evicted once the store grows past `max_bytes`.
+
+    The size is re-measured on disk before evicting and every
+    `CLIP_CACHE_RESCAN_INTERVAL` seconds, so processes sharing the store
+    keep to one budget. Clips held with `acquire` are never evicted by this
+    process; other processes evict least recently used clips first, and
+    `get` marks a clip as used.
+    """
+
+    def __init__(self,
+                 root: str = CLIP_CACHE_DIR,
+                 max_bytes: int = CLIP_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._index = OrderedDict()
+        self._pins = Counter()
+        self._scanned_at = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan(clean=True)
+
+    def _scan(self, clean: bool = False):
+        """
+        Rebuild the index from the files on disk, least recently used
+        first. With `clean`, delete temporary files left by crashed writers.
+        """
+        entries = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.endswith(TMP_SUFFIX):
+                    if clean:
+                        os.remove(path)
+                    continue
+                key, suffix = os.path.splitext(name)
+                if suffix not in (CLIP_SUFFIX, DECODED_SUFFIX):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process meanwhile
+                    continue
+                mtime, size = entries.get(key, (0, 0))
+                entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size)
+        self._index = OrderedDict()
+        self.total_bytes = 0
+        for key, (_, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            self._index[key] = size
+            self.total_bytes += size
+        self._scanned_at = time.monotonic()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}{CLIP_SUFFIX}")
+
+    def decoded_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}{DECODED_SUFFIX}")
+
+    def acquire(self, key: str):
+        """Keep the clip `key` from being evicted until `release`."""
+        self._pins[key] += 1
+
+    def release(self, key: str):
+        self._pins[key] -= 1
+        if self._pins[key] <= 0:
+            del self._pins[key]
+
+    def get(self, key: str) -> Optional[str]:
+        """Path of the cached clip, or None on a miss."""
+        path = self.path(key)
+        if os.path.exists(path):
+            self.hits += 1
+            if key not in self._index:
+                self._index[key] = os.path.getsize(path)
+                self.total_bytes += self._index[key]
+            self._index.move_to_end(key)
+            os.utime(path)
+            return path
+        if key in self._index:
+            self.total_bytes -= self._index.pop(key)
+        self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes) -> str:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, data)
+        self._added(key, len(data))
+        return path
+
+    async def put_stream(self,
+                         key: str,
+                         chunks: AsyncIterator[bytes],
+                         decode: bool = False) -> str:
+        """
+        Write a clip from `chunks` as they arrive. With `decode`, ffmpeg
+        decodes it alongside so the PCM is ready when the download ends.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid4().hex}{TMP_SUFFIX}"
+        decoder = await StreamingDecoder(
+            self.decoded_path(key)).start() if decode else None
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                async for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    if decoder is not None:
+                        await decoder.feed(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if decoder is not None:
+                decoded = await decoder.finish()
+                decoder = None
+                if decoded is not None:
+                    size += os.path.getsize(decoded)
+            os.replace(tmp, path)
+        finally:
+            if decoder is not None:
+                await decoder.abort()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._added(key, size)
+        return path
+
+    async def decode(self, key: str) -> Optional[str]:
+        """
+        Path of the decoded PCM of a cached clip, decoding it on the shared
+        pool first if needed. None if the clip is missing or undecodable.
+        """
+        decoded = self.decoded_path(key)
+        if os.path.exists(decoded):
+            return decoded
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        decoded = await decode_in_pool(path, decoded)
+        if decoded is not None and os.path.exists(path):
+            self._added(key,
+                        os.path.getsize(path) + os.path.getsize(decoded))
+        return decoded
+
+    def _added(self, key: str, size: int):
+        if key in self._index:
+            self.total_bytes -= self._index[key]
+        self._index[key] = size
+        self._index.move_to_end(key)
+        self.total_bytes += size
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None):
+        stale = time.monotonic() - self._scanned_at > CLIP_CACHE_RESCAN_INTERVAL
+        if self.total_bytes <= self.max_bytes and not stale:
+            return
+        self._scan()
+        if self.total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * EVICT_TO_FRACTION
+        for key, size in list(self._index.items()):
+            if self.total_bytes <= target:
+                break
+            if key == keep or self._pins[key]:
+                continue
+            del self._index[key]
+            self.total_bytes -= size
+            self.evictions += 1
+            for path in (self.path(key), self.decoded_path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "clips": len(self._index),
+            "bytes": self.total_bytes,
+        }
+
+
+_default_store = None
+
+
+def default_clip_store() -> ClipStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = ClipStore()
+    return _default_store
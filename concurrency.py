@@ -0,0 +1,128 @@
+import time
+import heapq
+import asyncio
+import itertools
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+
+# Order in which waiting requests get a slot: lowest first. Set per job and
+# stage with `prioritize`; tasks inherit it from whoever created them.
+_priority: ContextVar[Tuple[int, int]] = ContextVar("pdf2pod_priority",
+                                                    default=(0, 0))
+_arrivals = itertools.count()
+
+
+def prioritize(stage_rank: int, job_rank: Optional[int] = None):
+    """
+    Rank requests made from the current context: later pipeline stages
+    first, then earlier jobs.
+    """
+    job_rank = _priority.get()[1] if job_rank is None else job_rank
+    _priority.set((-stage_rank, job_rank))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a `Retry-After` header, given either as a number of
+    seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that grows while requests succeed and shrinks when the
+    upstream throttles (additive increase, multiplicative decrease).
+
+    A throttled response carrying `Retry-After` also pauses every new request
+    until that time has passed. Waiting requests are let through in priority
+    order (see `prioritize`), first come first served within a priority.
+
+        async with limiter:
+            response = await client.post(...)
+            limiter.record(response.status_code < 400,
+                           parse_retry_after(response.headers.get("retry-after")))
+    """
+
+    def __init__(self,
+                 min_limit: int = 1,
+                 max_limit: int = 8,
+                 initial_limit: Optional[int] = None):
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError(
+                f"Invalid concurrency limits: min={min_limit}, max={max_limit}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(
+            min(max_limit, max(min_limit, initial_limit or min_limit)))
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.blocked_until = 0.0
+        self._condition = asyncio.Condition()
+        self._waiting = []
+
+    async def acquire(self):
+        entry = (_priority.get(), next(_arrivals))
+        async with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    delay = self.blocked_until - time.monotonic()
+                    if delay > 0:
+                        try:
+                            await asyncio.wait_for(self._condition.wait(),
+                                                   delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    if self.in_flight < int(
+                            self.limit) and self._waiting[0] == entry:
+                        break
+                    await self._condition.wait()
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self.in_flight += 1
+            # The next waiter may fit under the limit as well
+            self._condition.notify_all()
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+    def record(self, success: bool, retry_after: Optional[float] = None):
+        """
+        Adjust the limit after a request: +1 per window of successes, halved
+        on throttling.
+        """
+        if success:
+            self.successes += 1
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            return
+        self.throttled += 1
+        self.limit = max(self.min_limit, self.limit / 2)
+        if retry_after:
+            self.blocked_until = max(self.blocked_until,
+                                     time.monotonic() + retry_after)
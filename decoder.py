@@ -0,0 +1,119 @@
+import os
+import asyncio
+import subprocess
+from uuid import uuid4
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+# ffmpeg processes decoding finished clips at once
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", os.cpu_count() or 1))
+
+
+def ffmpeg_available() -> bool:
+    from pydub.utils import get_encoder_name, which
+    return which(get_encoder_name()) is not None
+
+
+def _decode_command(source: str, target: str) -> List[str]:
+    from pydub.utils import get_encoder_name
+    return [
+        get_encoder_name(), "-y", "-loglevel", "error", "-i", source, "-vn",
+        "-acodec", "pcm_s16le", "-f", "wav", target
+    ]
+
+
+def decode_file(source: str, path: str) -> Optional[str]:
+    """
+    Decode the audio file `source` to 16-bit PCM WAV at `path`. Returns
+    `path`, or None if ffmpeg could not decode it.
+    """
+    tmp = f"{path}.{uuid4().hex}.tmp"
+    try:
+        result = subprocess.run(_decode_command(source, tmp),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        if result.returncode != 0 or not os.path.exists(tmp):
+            return None
+        os.replace(tmp, path)
+        return path
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+_executor = None
+
+
+def decode_executor() -> ThreadPoolExecutor:
+    """
+    Shared pool for decoding. Each worker waits on an ffmpeg process, so
+    decodes run in parallel on separate cores.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS,
+                                       thread_name_prefix="decode")
+    return _executor
+
+
+async def decode_in_pool(source: str, path: str) -> Optional[str]:
+    """`decode_file` on the shared pool, without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(
+        decode_executor(), decode_file, source, path)
+
+
+class StreamingDecoder:
+    """
+    Decodes compressed audio with ffmpeg while its bytes are still arriving,
+    writing 16-bit PCM WAV to `path` once the input is complete.
+
+    The WAV is written to a temp file and renamed into place, so a failed or
+    abandoned decode never leaves a partial file behind.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = f"{path}.{uuid4().hex}.tmp"
+        self.process = None
+        self.failed = False
+
+    async def start(self) -> "StreamingDecoder":
+        self.process = await asyncio.create_subprocess_exec(
+            *_decode_command("pipe:0", self.tmp),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+        return self
+
+    async def feed(self, chunk: bytes):
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.failed = True
+
+    async def finish(self) -> Optional[str]:
+        """Path of the decoded WAV, or None if ffmpeg could not decode it."""
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            self.failed = True
+        returncode = await self.process.wait()
+        if self.failed or returncode != 0 or not os.path.exists(self.tmp):
+            self._cleanup()
+            return None
+        os.replace(self.tmp, self.path)
+        return self.path
+
+    async def abort(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self._cleanup()
+
+    def _cleanup(self):
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
@@ -1,12 +1,25 @@
+import os
 import json
+import asyncio
+import metrics
 from llm import OpenAIWrapper
+from chunking import count_tokens, split_text
 from prompts import DIALOGUE_PROMPT
-from pdf_reader import parse_pdf
-from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional, Literal
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Dict, Any, Optional, Literal, Tuple
 
 openai_wrapper = OpenAIWrapper()
 
+DIALOGUE_MODEL = os.getenv("DIALOGUE_MODEL", "gpt-4o")
+# Inputs above this many tokens are summarised section by section first
+DIALOGUE_TOKEN_BUDGET = int(os.getenv("DIALOGUE_TOKEN_BUDGET", 48000))
+SECTION_TOKENS = int(os.getenv("SECTION_TOKENS", 12000))
+SECTION_CONCURRENCY = 4
+# A dialogue cut off mid-way is continued from its last complete turn up to
+# this many times; one without any usable turn is generated again instead
+DIALOGUE_MAX_REPAIRS = int(os.getenv("DIALOGUE_MAX_REPAIRS", 2))
+DIALOGUE_MAX_RETRIES = int(os.getenv("DIALOGUE_MAX_RETRIES", 1))
+
 
 class Scratchpad(BaseModel):
     observation: str = Field(
@@ -70,9 +83,6 @@ class Dialogue(BaseModel):
     )
 
 
-print(DialogueTurn.model_json_schema())
-
-
 async def generate_scratchpad_ideas(text: str, **kwargs) -> ScratchpadIdeas:
     """
     Generate a list of brainstorming ideas for the dialogue from the given text using the OpenAI API.
@@ -88,20 +98,95 @@ async def generate_scratchpad_ideas(text: str, **kwargs) -> ScratchpadIdeas:
     if "user_instruction" in kwargs:
         user_msg += f"\n<user_instruction>\n{kwargs['user_instruction']}\n</user_instruction>"
     messages.append({"role": "user", "content": user_msg})
-    response = await openai_wrapper.function_call("gpt-4o",
-                                                  messages,
-                                                  functions,
-                                                  max_tokens=4096)
+    with metrics.span("scratchpad"):
+        response = await openai_wrapper.function_call(DIALOGUE_MODEL,
+                                                      messages,
+                                                      functions,
+                                                      max_tokens=4096)
     return json.loads(response.arguments)
 
 
-async def generate_dialogue(text: str, user_instruction: str = ""):
+async def generate_section_ideas(sections: List[str],
+                                 user_instruction: str = ""
+                                 ) -> List[ScratchpadIdeas]:
     """
-    Generate a dialogue from the given text using the OpenAI API.
+    Generate scratchpad ideas for each section of a long document concurrently.
     """
-    scratchpad_ideas = await generate_scratchpad_ideas(
-        text, user_instruction=user_instruction)
-    print("Scratchpad Ideas: \n", json.dumps(scratchpad_ideas, indent=2))
+    semaphore = asyncio.Semaphore(SECTION_CONCURRENCY)
+
+    async def generate(ix, section):
+        async with semaphore:
+            return await generate_scratchpad_ideas(
+                f"[Section {ix + 1} of {len(sections)}]\n{section}",
+                user_instruction=user_instruction)
+
+    return await asyncio.gather(
+        *[generate(ix, section) for ix, section in enumerate(sections)])
+
+
+async def merge_scratchpad_ideas(section_ideas: List[ScratchpadIdeas],
+                                 user_instruction: str = ""
+                                 ) -> ScratchpadIdeas:
+    """
+    Merge the scratchpad ideas of consecutive sections into one compact
+    outline. Groups that do not fit the token budget are merged in rounds.
+    """
+    if len(section_ideas) == 1:
+        return section_ideas[0]
+
+    groups = [[]]
+    for ideas in section_ideas:
+        tokens = count_tokens(json.dumps(groups[-1] + [ideas]))
+        if groups[-1] and tokens > DIALOGUE_TOKEN_BUDGET:
+            groups.append([])
+        groups[-1].append(ideas)
+    if len(groups) == 1:
+        return await _merge_group(section_ideas, user_instruction)
+    if len(groups) == len(section_ideas):
+        # No two outlines fit the budget together; merge them in pairs
+        # anyway, so every round shrinks the list
+        groups = [
+            section_ideas[ix:ix + 2]
+            for ix in range(0, len(section_ideas), 2)
+        ]
+    merged = await asyncio.gather(
+        *[_merge_group(group, user_instruction) for group in groups])
+    return await merge_scratchpad_ideas(list(merged), user_instruction)
+
+
+async def _merge_group(section_ideas: List[ScratchpadIdeas],
+                       user_instruction: str) -> ScratchpadIdeas:
+    """Merge `section_ideas` in a single call, whatever their size."""
+    if len(section_ideas) == 1:
+        return section_ideas[0]
+    functions = [{
+        "name": "merge_scratchpad_ideas",
+        "description":
+        "Merge scratchpad ideas from consecutive sections of one document into a single outline",
+        "parameters": ScratchpadIdeas.model_json_schema()
+    }]
+    user_msg = f"<section_scratchpads>\n{json.dumps(section_ideas, indent=2)}\n</section_scratchpads>\nThese are scratchpad ideas for consecutive sections of one document. Merge them into a single compact set of scratchpad ideas covering the whole document: keep the strongest ideas, drop repetition and use one consistent set of speakers."
+    if user_instruction:
+        user_msg += f"\n<user_instruction>\n{user_instruction}\n</user_instruction>"
+    messages = [{
+        "role": "system",
+        "content": DIALOGUE_PROMPT
+    }, {
+        "role": "user",
+        "content": user_msg
+    }]
+    with metrics.span("merge_scratchpad", sections=len(section_ideas)):
+        response = await openai_wrapper.function_call(
+            DIALOGUE_MODEL,
+            messages,
+            functions,
+            function_call="merge_scratchpad_ideas",
+            max_tokens=4096)
+    return json.loads(response.arguments)
+
+
+def _dialogue_request(text: str, scratchpad_ideas: Dict[str, Any],
+                      user_instruction: str):
     messages = [{
         "role": "system",
         "content": DIALOGUE_PROMPT
@@ -117,17 +202,244 @@ async def generate_dialogue(text: str, user_instruction: str = ""):
         "Generate a dialogue from the given text using the OpenAI API.",
         "parameters": Dialogue.model_json_schema()
     }]
-    response = await openai_wrapper.function_call(
-        "gpt-4o",
-        messages,
-        functions,
-        function_call="generate_dialogue",
-        max_tokens=8192)
-    return json.loads(response.arguments)
+    return messages, functions
+
+
+async def plan_dialogue(text: str,
+                        user_instruction: str = "",
+                        long_document: Optional[bool] = None,
+                        sections: Optional[List[str]] = None
+                        ) -> Dict[str, Any]:
+    """
+    Generate the scratchpad ideas for a dialogue. Returns them with the text
+    the dialogue call should see: the document itself, or its section
+    summaries for long documents. Pass `sections` if `text` was already
+    split into sections of `SECTION_TOKENS` tokens.
+    """
+    if long_document is None:
+        long_document = count_tokens(text) > DIALOGUE_TOKEN_BUDGET
+    if long_document:
+        sections = sections or split_text(text, SECTION_TOKENS)
+        print(f"Long document: {len(sections)} sections")
+        metrics.current_span().set(sections=len(sections))
+        section_ideas = await generate_section_ideas(sections,
+                                                     user_instruction)
+        scratchpad_ideas = await merge_scratchpad_ideas(
+            section_ideas, user_instruction)
+        # The dialogue call gets section summaries instead of the full text
+        text = "\n\n".join(
+            f"Section {ix + 1}: {ideas['about_the_document']}"
+            for ix, ideas in enumerate(section_ideas))
+    else:
+        scratchpad_ideas = await generate_scratchpad_ideas(
+            text, user_instruction=user_instruction)
+    print("Scratchpad Ideas: \n", json.dumps(scratchpad_ideas, indent=2))
+    return {"text": text, "scratchpad_ideas": scratchpad_ideas}
+
+
+async def _prepare_dialogue(text: str, user_instruction: str,
+                            long_document: Optional[bool],
+                            plan: Optional[Dict[str, Any]]):
+    if plan is None:
+        plan = await plan_dialogue(text, user_instruction, long_document)
+    return _dialogue_request(plan["text"], plan["scratchpad_ideas"],
+                             user_instruction)
+
+
+def validate_turns(turns: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The turns that match `DialogueTurn`. Invalid ones are dropped."""
+    valid = []
+    for turn in turns:
+        try:
+            valid.append(
+                DialogueTurn.model_validate(turn).model_dump(
+                    exclude_none=True))
+        except ValidationError as e:
+            print(f"Dropping invalid dialogue turn: {e.errors()[0]['msg']}")
+            metrics.current_span().add("invalid_turns")
+    return valid
+
+
+def salvage_dialogue(arguments: str) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    The valid turns in the arguments of a `generate_dialogue` call, and
+    whether the arguments were complete. Every complete turn is recovered
+    from output that was cut off or is malformed elsewhere.
+    """
+    parser = DialogueTurnParser()
+    turns = validate_turns(parser.feed(arguments))
+    return turns, parser.closed
+
+
+def _continuation(messages: List[Dict[str, Any]],
+                  turns: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return messages + [{
+        "role": "assistant",
+        "content": json.dumps({"dialogue": turns}, ensure_ascii=False)
+    }, {
+        "role":
+        "user",
+        "content":
+        f"The dialogue above was cut off after {len(turns)} turns. Continue it: generate only the turns that come after the last one, and bring the conversation to a natural close."
+    }]
+
+
+def _next_request(messages: List[Dict[str, Any]],
+                  turns: List[Dict[str, Any]], complete: bool,
+                  attempts: Dict[str, int]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Messages for another dialogue call, or None once `turns` is final. A
+    dialogue that was cut off is continued from its last valid turn; one
+    without any valid turn is generated again from scratch.
+    """
+    span = metrics.current_span()
+    if complete and turns:
+        return None
+    if turns:
+        if attempts["repairs"] >= DIALOGUE_MAX_REPAIRS:
+            print(f"Dialogue still cut off after {attempts['repairs']} "
+                  f"continuations, keeping its {len(turns)} turns")
+            return None
+        attempts["repairs"] += 1
+        span.add("dialogue_repairs")
+        print(f"Dialogue cut off after {len(turns)} turns, "
+              "requesting the rest")
+        return _continuation(messages, turns)
+    if attempts["retries"] >= DIALOGUE_MAX_RETRIES:
+        raise ValueError("The model returned no valid dialogue turns")
+    attempts["retries"] += 1
+    span.add("dialogue_retries")
+    print("No valid dialogue turns, generating the dialogue again")
+    return messages
+
+
+async def generate_dialogue(text: str,
+                            user_instruction: str = "",
+                            long_document: Optional[bool] = None,
+                            plan: Optional[Dict[str, Any]] = None):
+    """
+    Generate a dialogue from the given text using the OpenAI API.
+
+    Texts over `DIALOGUE_TOKEN_BUDGET` tokens (or any text with
+    `long_document=True`) are split into sections whose scratchpad ideas
+    are generated concurrently and merged, keeping every prompt bounded.
+    A `plan` from `plan_dialogue` skips the scratchpad step.
+
+    Turns are validated against `DialogueTurn`. If the output is cut off,
+    its complete turns are kept and only the rest is requested.
+    """
+    messages, functions = await _prepare_dialogue(text, user_instruction,
+                                                  long_document, plan)
+    turns = []
+    attempts = {"repairs": 0, "retries": 0}
+    request = messages
+    with metrics.span("dialogue_call"):
+        while request is not None:
+            response = await openai_wrapper.function_call(
+                DIALOGUE_MODEL,
+                request,
+                functions,
+                function_call="generate_dialogue",
+                max_tokens=8192,
+                # A cached answer would only fail again
+                use_cache=attempts["retries"] == 0)
+            received, complete = salvage_dialogue(
+                getattr(response, "arguments", None) or "")
+            turns += received
+            request = _next_request(messages, turns, complete, attempts)
+    return {"dialogue": turns}
+
+
+class DialogueTurnParser:
+    """
+    Incrementally extracts complete dialogue turns from the streamed
+    arguments of a `generate_dialogue` call.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start = None
+        # Set once the outer object is closed, i.e. the output is complete
+        self.closed = False
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.buffer += chunk
+        turns = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                # {"dialogue": [{turn}, ...]}: turns open at depth 3
+                if self.depth == 3 and char == "{":
+                    self.start = self.position
+            elif char in "}]":
+                if self.depth == 3 and self.start is not None:
+                    try:
+                        turns.append(
+                            json.loads(self.buffer[self.start:self.position +
+                                                   1]))
+                    except ValueError:
+                        print("Dropping malformed dialogue turn")
+                        metrics.current_span().add("invalid_turns")
+                    self.start = None
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+            self.position += 1
+
+        # Only the turn being parsed needs to stay buffered
+        keep = self.start if self.start is not None else self.position
+        self.buffer = self.buffer[keep:]
+        self.position -= keep
+        if self.start is not None:
+            self.start = 0
+        return turns
+
+
+async def generate_dialogue_stream(text: str,
+                                   user_instruction: str = "",
+                                   long_document: Optional[bool] = None,
+                                   plan: Optional[Dict[str, Any]] = None):
+    """
+    Generate a dialogue like `generate_dialogue`, yielding each turn (with its
+    overlaps) as soon as the model has finished writing it. A stream that is
+    cut off is continued from its last valid turn.
+    """
+    messages, functions = await _prepare_dialogue(text, user_instruction,
+                                                  long_document, plan)
+    turns = []
+    attempts = {"repairs": 0, "retries": 0}
+    request = messages
+    while request is not None:
+        parser = DialogueTurnParser()
+        async for chunk in openai_wrapper.stream_function_call(
+                DIALOGUE_MODEL,
+                request,
+                functions,
+                function_call="generate_dialogue",
+                max_tokens=8192):
+            for turn in validate_turns(parser.feed(chunk)):
+                turns.append(turn)
+                yield turn
+        request = _next_request(messages, turns, parser.closed, attempts)
 
 
 if __name__ == "__main__":
     import asyncio
+    from pdf_reader import parse_pdf
     text = parse_pdf("/Users/vatsalsaglani/Downloads/papers/2310.08560.pdf")
     text = list(
         filter(lambda t: [t for t in t if t["type"] == "text"],
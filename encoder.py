@@ -0,0 +1,136 @@
+import os
+import wave
+import subprocess
+from uuid import uuid4
+from typing import Optional
+from pydub import AudioSegment
+from pydub.utils import get_encoder_name
+
+# ffmpeg arguments per output format
+CODECS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "128k", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-b:a", "64k", "-f", "ogg"],
+}
+_RAW_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
+
+
+class AudioWriter:
+    """
+    Writes an episode to `path` a chunk at a time, so only the chunk being
+    written is held in memory. The output appears at `path` on `close`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = f"{path}.{uuid4().hex}.tmp"
+        self.frames = 0
+        self.format = None
+
+    def write(self, audio: AudioSegment):
+        if self.format is None:
+            self.format = (audio.channels, audio.sample_width,
+                           audio.frame_rate)
+            self._open()
+        if audio.raw_data:
+            self._write(audio.raw_data)
+            self.frames += int(audio.frame_count())
+
+    def close(self):
+        if self.format is None:
+            # Nothing was written: still produce a valid, empty file
+            self.write(AudioSegment.silent(duration=0))
+        self._close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        if self.format is not None:
+            try:
+                self._close()
+            except Exception:
+                pass
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _write(self, data: bytes):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class WavWriter(AudioWriter):
+
+    def _open(self):
+        channels, sample_width, frame_rate = self.format
+        self.wav = wave.open(self.tmp, "wb")
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(sample_width)
+        self.wav.setframerate(frame_rate)
+
+    def _write(self, data: bytes):
+        self.wav.writeframes(data)
+
+    def _close(self):
+        self.wav.close()
+
+
+class FfmpegWriter(AudioWriter):
+    """Pipes raw PCM into an ffmpeg encoder as it is rendered."""
+
+    def __init__(self, path: str, output_format: str):
+        super().__init__(path)
+        self.output_format = output_format
+        self.process = None
+
+    def _open(self):
+        channels, sample_width, frame_rate = self.format
+        self.process = subprocess.Popen(
+            [
+                # Only errors go to stderr, so the pipe cannot fill up
+                get_encoder_name(), "-y", "-hide_banner", "-nostats",
+                "-loglevel", "error", "-f", _RAW_FORMATS[sample_width],
+                "-ar",
+                str(frame_rate), "-ac",
+                str(channels), "-i", "pipe:0", *CODECS[self.output_format],
+                self.tmp
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+
+    def _write(self, data: bytes):
+        self.process.stdin.write(data)
+
+    def _close(self):
+        self.process.stdin.close()
+        stderr = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise RuntimeError(
+                f"Encoding {self.path} failed: {stderr.decode(errors='replace')}")
+
+
+def output_format(path: str) -> str:
+    return os.path.splitext(path)[1].lstrip(".").lower() or "wav"
+
+
+def open_writer(path: str, fmt: Optional[str] = None) -> AudioWriter:
+    """A writer for `path`, encoding to `fmt` (default: from its extension)."""
+    fmt = fmt or output_format(path)
+    if fmt == "wav":
+        return WavWriter(path)
+    if fmt in CODECS:
+        return FfmpegWriter(path, fmt)
+    raise ValueError(f"Unsupported output format: {fmt}")
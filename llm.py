@@ -1,51 +1,420 @@
-from openai import AsyncOpenAI
 import os
+import json
+import time
+import asyncio
+import hashlib
+import bisect
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, TYPE_CHECKING
+from clip_store import atomic_write, TMP_SUFFIX
+from concurrency import AdaptiveLimiter, parse_retry_after
+import contextlib
+import metrics
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from openai.types.chat import ChatCompletion
 
 load_dotenv()
 
+LLM_CACHE = os.getenv("LLM_CACHE", "0") == "1"
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(".cache", "llm"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024**2))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+# Seconds a completion may take, hedges included, before it is abandoned
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 300))
+# Seconds a stream may go without a chunk before it is abandoned
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", 60))
+# Send a duplicate request once a call is slower than this percentile of
+# recent calls of the same model and type
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 95))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 10))
+# At most this many duplicates per call, and this share of all calls
+LLM_MAX_HEDGES = int(os.getenv("LLM_MAX_HEDGES", 1))
+LLM_HEDGE_RATIO = float(os.getenv("LLM_HEDGE_RATIO", 0.1))
+
+
+class ResponseCache:
+    """
+    On-disk cache of chat completion responses.
+
+    Entries expire `ttl` seconds after they were written and the least
+    recently used ones are evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self,
+                 root: str = LLM_CACHE_DIR,
+                 ttl: Optional[float] = LLM_CACHE_TTL,
+                 max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._index = OrderedDict()
+        os.makedirs(root, exist_ok=True)
+        entries = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith(TMP_SUFFIX):
+                os.remove(path)
+            elif name.endswith(".json"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def key(model: str, messages: List[Dict], **kwargs) -> str:
+        """Canonical hash of the model, messages, tools and sampling kwargs."""
+        payload = json.dumps({
+            "model": model,
+            "messages": messages,
+            **kwargs
+        },
+                             sort_keys=True,
+                             ensure_ascii=False,
+                             separators=(",", ":"),
+                             default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def _forget(self, key: str):
+        self.total_bytes -= self._index.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional["ChatCompletion"]:
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            self._forget(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        if key in self._index:
+            self._index.move_to_end(key)
+        os.utime(self.path(key))
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate(entry["response"])
+
+    def put(self, key: str, response: "ChatCompletion"):
+        data = json.dumps({
+            "created": time.time(),
+            "response": response.model_dump(mode="json")
+        }).encode("utf-8")
+        atomic_write(self.path(key), data)
+        self.total_bytes -= self._index.pop(key, 0)
+        self._index[key] = len(data)
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            self._forget(next(iter(self._index)))
+
+
+class LatencyHistogram:
+    """
+    Latencies of the last `window` calls, bucketed on a log scale from
+    100 ms to 10 minutes. Percentiles are read from the bucket bounds, so
+    they are accurate to one bucket width (25%).
+    """
+
+    BOUNDS = [0.1 * 1.25**i for i in range(40)]
+
+    def __init__(self, window: int = 200):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds: float):
+        if len(self.samples) == self.samples.maxlen:
+            self.counts[self.samples[0]] -= 1
+        bucket = bisect.bisect_left(self.BOUNDS, seconds)
+        self.samples.append(bucket)
+        self.counts[bucket] += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Upper bound of the `p`th percentile, or None without samples."""
+        if not self.samples:
+            return None
+        rank = p / 100 * len(self.samples)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.BOUNDS[min(bucket, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+def _record_usage(span, response: "ChatCompletion"):
+    if response.usage is not None:
+        span.add("prompt_tokens", response.usage.prompt_tokens)
+        span.add("completion_tokens", response.usage.completion_tokens)
+
+
+async def _idle_bounded(stream, idle_timeout: float, span):
+    """Chunks of `stream`, closing it if one takes over `idle_timeout`s."""
+    chunks = stream.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(),
+                                               idle_timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                span.add("deadline_exceeded")
+                raise TimeoutError(f"No chunk for {idle_timeout:g}s, "
+                                   "abandoning the stream") from None
+            yield chunk
+    finally:
+        await stream.close()
+
 
 class OpenAIWrapper:
+    """
+    Chat completions with optional response caching. Set `limiter` to share
+    one request budget between everything that uses this wrapper.
 
-    def __init__(self):
-        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    The OpenAI client and the default cache are created on first use, so
+    constructing a wrapper is cheap and needs no API key.
 
-    async def complete(self, model: str, messages: List[Dict], **kwargs):
-        response = await self.client.chat.completions.create(model=model,
-                                                             messages=messages,
-                                                             **kwargs)
-        return response
+    Completions are abandoned after `timeout` seconds. With `hedge`, a call
+    still running past the `hedge_percentile` latency of recent calls of the
+    same model and call type gets a duplicate request, and the first answer
+    wins. Hedges are capped at `max_hedges` per call and `hedge_ratio` of
+    all calls.
+    """
 
-    async def function_call(self, model: str, messages: List[Dict],
-                            functions: List[Dict], **kwargs):
-        functions = [{
+    def __init__(self,
+                 cache: Optional[ResponseCache] = None,
+                 limiter: Optional[AdaptiveLimiter] = None,
+                 timeout: float = LLM_TIMEOUT,
+                 hedge: bool = LLM_HEDGE,
+                 hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+                 max_hedges: int = LLM_MAX_HEDGES,
+                 hedge_ratio: float = LLM_HEDGE_RATIO):
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.max_hedges = max_hedges
+        self.hedge_ratio = hedge_ratio
+        self.latency = {}
+        self.calls = 0
+        self.hedges = 0
+        self._client = None
+        self._cache = cache
+        self._default_cache = cache is None and LLM_CACHE
+        self.limiter = limiter
+        self._in_flight = {}
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    @property
+    def cache(self) -> Optional[ResponseCache]:
+        if self._default_cache:
+            self._default_cache = False
+            self._cache = ResponseCache()
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache: Optional[ResponseCache]):
+        self._default_cache = False
+        self._cache = cache
+
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        if self.limiter is None:
+            yield
+            return
+        from openai import RateLimitError
+        async with self.limiter:
+            try:
+                yield
+            except RateLimitError as e:
+                self.limiter.record(
+                    False,
+                    parse_retry_after(e.response.headers.get("retry-after")))
+                raise
+            self.limiter.record(True)
+
+    async def _attempt(self, **kwargs):
+        async with self._slot():
+            return await self.client.chat.completions.create(**kwargs)
+
+    def _hedge_delay(self, histogram: LatencyHistogram) -> Optional[float]:
+        if not self.hedge or len(histogram) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return histogram.percentile(self.hedge_percentile)
+
+    async def _create(self,
+                      call_type: str = "chat",
+                      timeout: Optional[float] = None,
+                      **kwargs):
+        """
+        One completion, hedged and bounded by the deadline. Raises
+        `TimeoutError` if no attempt answers in time, or the error of the
+        last attempt if all of them fail.
+        """
+        span = metrics.current_span()
+        histogram = self.latency.setdefault((kwargs.get("model"), call_type),
+                                            LatencyHistogram())
+        delay = self._hedge_delay(histogram)
+        timeout = self.timeout if timeout is None else timeout
+        self.calls += 1
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + timeout
+        attempts = [asyncio.ensure_future(self._attempt(**kwargs))]
+        pending = set(attempts)
+        try:
+            while True:
+                wake = deadline
+                can_hedge = (delay is not None
+                             and len(attempts) <= self.max_hedges
+                             and self.hedges < self.hedge_ratio * self.calls)
+                if can_hedge:
+                    wake = min(wake, started + delay * len(attempts))
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(0, wake - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        histogram.add(loop.time() - started)
+                        if attempt is not attempts[0]:
+                            span.add("hedge_wins")
+                        return attempt.result()
+                    if not pending:
+                        raise attempt.exception()
+                if loop.time() >= deadline:
+                    span.add("deadline_exceeded")
+                    raise TimeoutError(
+                        f"{kwargs.get('model')} {call_type} call took longer "
+                        f"than {timeout:g}s")
+                if can_hedge and not done:
+                    self.hedges += 1
+                    span.add("hedges")
+                    attempt = asyncio.ensure_future(self._attempt(**kwargs))
+                    attempts.append(attempt)
+                    pending.add(attempt)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def latency_stats(self) -> Dict[str, Dict[str, float]]:
+        """Recent p50/p95 latency per model and call type."""
+        return {
+            f"{model}/{call_type}": {
+                "calls": len(histogram),
+                "p50": histogram.percentile(50),
+                "p95": histogram.percentile(95),
+            }
+            for (model, call_type), histogram in self.latency.items()
+        }
+
+    async def complete(self,
+                       model: str,
+                       messages: List[Dict],
+                       use_cache: bool = True,
+                       call_type: str = "chat",
+                       timeout: Optional[float] = None,
+                       **kwargs):
+        """
+        Create a chat completion. With a cache configured, responses are
+        served from disk and concurrent identical requests share a single
+        upstream call; `use_cache=False` bypasses both. Latencies for
+        hedging are tracked per model and `call_type`; `timeout` overrides
+        the wrapper's deadline.
+        """
+        with metrics.span("llm.complete", model=model,
+                          call_type=call_type) as span:
+            if self.cache is None or not use_cache:
+                response = await self._create(call_type,
+                                              timeout,
+                                              model=model,
+                                              messages=messages,
+                                              **kwargs)
+                _record_usage(span, response)
+                return response
+
+            key = self.cache.key(model, messages, **kwargs)
+            response = self.cache.get(key)
+            if response is not None:
+                span.add("cache_hits")
+                return response
+            span.add("cache_misses")
+            if key not in self._in_flight:
+                self._in_flight[key] = asyncio.ensure_future(
+                    self._complete_and_cache(key, model, messages,
+                                             call_type, timeout, **kwargs))
+            else:
+                span.set(deduplicated=True)
+            response = await asyncio.shield(self._in_flight[key])
+            _record_usage(span, response)
+            return response
+
+    async def _complete_and_cache(self, key: str, model: str,
+                                  messages: List[Dict], call_type: str,
+                                  timeout: Optional[float], **kwargs):
+        try:
+            response = await self._create(call_type,
+                                          timeout,
+                                          model=model,
+                                          messages=messages,
+                                          **kwargs)
+            self.cache.put(key, response)
+            return response
+        finally:
+            del self._in_flight[key]
+
+    @staticmethod
+    def _tools(functions: List[Dict], function_call: str = "auto"):
+        tools = [{
             "type": "function",
             "function": function
         } for function in functions]
-        print(kwargs.get("function_call", "auto"))
-        if kwargs.get("function_call", "auto") == "auto":
+        if function_call == "auto":
             choice = "auto"
         else:
-            choice = {
-                "type": "function",
-                "function": {
-                    "name": kwargs.get("function_call", "auto")
-                }
-            }
-            del kwargs["function_call"]
-        print(choice)
+            choice = {"type": "function", "function": {"name": function_call}}
+        return tools, choice
+
+    async def function_call(self, model: str, messages: List[Dict],
+                            functions: List[Dict], **kwargs):
+        function_call = kwargs.pop("function_call", "auto")
+        # Calls are timed per function, e.g. scratchpad apart from dialogue
+        kwargs.setdefault(
+            "call_type", functions[0]["name"]
+            if function_call == "auto" else function_call)
+        functions, choice = self._tools(functions, function_call)
         if "tool_choice" in kwargs:
             del kwargs["tool_choice"]
-        print(kwargs)
         response = await self.complete(model,
                                        messages,
                                        tools=functions,
                                        tool_choice=choice,
                                        **kwargs)
         response = response.choices[0].message
-        print(response)
-        print('\n\n\n')
         if response.tool_calls:
             return response.tool_calls[0].function
         else:
@@ -61,6 +430,52 @@ class OpenAIWrapper:
             if content is not None:
                 yield content
 
+    async def stream_function_call(self, model: str, messages: List[Dict],
+                                   functions: List[Dict], **kwargs):
+        """
+        Stream the arguments of the first tool call as they are generated.
+        The stream is abandoned with `TimeoutError` if the response or its
+        next chunk takes longer than `idle_timeout` seconds.
+        """
+        functions, choice = self._tools(functions,
+                                        kwargs.pop("function_call", "auto"))
+        kwargs.pop("tool_choice", None)
+        kwargs.pop("use_cache", None)
+        kwargs.pop("call_type", None)
+        idle_timeout = kwargs.pop("idle_timeout", LLM_STREAM_IDLE_TIMEOUT)
+        with metrics.span("llm.stream", activate=False, model=model) as span:
+            # The request holds its slot until the stream is finished
+            async with self._slot():
+                started = time.perf_counter()
+                first_chunk = True
+                try:
+                    response = await asyncio.wait_for(
+                        self.client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            tools=functions,
+                            tool_choice=choice,
+                            stream=True,
+                            **kwargs), idle_timeout)
+                except asyncio.TimeoutError:
+                    span.add("deadline_exceeded")
+                    raise TimeoutError(
+                        f"{model} stream did not start within "
+                        f"{idle_timeout:g}s") from None
+                async for chunk in _idle_bounded(response, idle_timeout,
+                                                 span):
+                    if not chunk.choices or not chunk.choices[
+                            0].delta.tool_calls:
+                        continue
+                    tool_call = chunk.choices[0].delta.tool_calls[0]
+                    if tool_call.index == 0 and tool_call.function and tool_call.function.arguments:
+                        span.add("chunks")
+                        if first_chunk:
+                            first_chunk = False
+                            span.set(first_chunk_seconds=time.perf_counter() -
+                                     started)
+                        yield tool_call.function.arguments
+
 
 if __name__ == "__main__":
     import asyncio
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import threading
+from contextvars import ContextVar
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, List, Optional
+
+METRICS_ENABLED = os.getenv("PDF2POD_METRICS", "0") == "1"
+METRICS_PORT = os.getenv("PDF2POD_METRICS_PORT")
+
+
+class Span:
+    """
+    A timed stage or API call. Counters (tokens, bytes, retries, cache hits)
+    are summed into the Prometheus totals; attributes are only reported.
+    """
+
+    def __init__(self,
+                 recorder: "Recorder",
+                 name: str,
+                 parent: Optional["Span"],
+                 attributes: Dict[str, Any],
+                 activate: bool = True):
+        self.recorder = recorder
+        self.activate = activate
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.counters = defaultdict(float)
+        self.children: List["Span"] = []
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.end = None
+        self.error = None
+        self._token = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, counter: str, value: float = 1):
+        self.counters[counter] += value
+
+    def __enter__(self):
+        if self.activate:
+            self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc is not None:
+            self.error = repr(exc)
+        if self._token is not None:
+            _current_span.reset(self._token)
+        self.recorder._finish(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "seconds": round(self.duration, 6),
+            "attributes": self.attributes,
+            "counters": dict(self.counters),
+            "error": self.error,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+class _NoopSpan:
+    """Shared stand-in used while instrumentation is disabled."""
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, counter: str, value: float = 1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span: ContextVar[Optional[Span]] = ContextVar("pdf2pod_span",
+                                                       default=None)
+
+
+class Recorder:
+    """
+    Collects spans into per-run trees and running Prometheus totals.
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._count = defaultdict(int)
+        self._seconds = defaultdict(float)
+        self._errors = defaultdict(int)
+        self._counters = defaultdict(float)
+
+    def span(self, name: str, activate: bool = True, **attributes):
+        """
+        Open a span under the current one. Spans opened inside async
+        generators should pass `activate=False`: they still record, but do
+        not become the parent of spans the consumer opens between yields.
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        span = Span(self, name, parent, attributes, activate)
+        if parent is not None:
+            parent.children.append(span)
+        return span
+
+    def _finish(self, span: Span):
+        with self._lock:
+            self._count[span.name] += 1
+            self._seconds[span.name] += span.duration
+            if span.error is not None:
+                self._errors[span.name] += 1
+            for counter, value in span.counters.items():
+                self._counters[(span.name, counter)] += value
+
+    def report(self, root: Span) -> Dict[str, Any]:
+        """JSON-serialisable run report: the span tree plus totals."""
+        totals = defaultdict(float)
+        stages = defaultdict(float)
+
+        def walk(span):
+            stages[span.name] += span.duration
+            for counter, value in span.counters.items():
+                totals[counter] += value
+            for child in span.children:
+                walk(child)
+
+        walk(root)
+        return {
+            "seconds": round(root.duration, 6),
+            "totals": dict(totals),
+            "stages": {name: round(s, 6)
+                       for name, s in stages.items()},
+            "trace": root.to_dict(),
+        }
+
+    def write_report(self, root: Span, path: str):
+        with open(path, "w") as f:
+            json.dump(self.report(root), f, indent=2, default=str)
+
+    def prometheus(self) -> str:
+        """Totals in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE pdf2pod_span_seconds summary",
+        ]
+        with self._lock:
+            for name in sorted(self._count):
+                lines.append(
+                    f'pdf2pod_span_seconds_count{{span="{name}"}} {self._count[name]}'
+                )
+                lines.append(
+                    f'pdf2pod_span_seconds_sum{{span="{name}"}} {self._seconds[name]:.6f}'
+                )
+            lines.append("# TYPE pdf2pod_span_errors_total counter")
+            for name in sorted(self._errors):
+                lines.append(
+                    f'pdf2pod_span_errors_total{{span="{name}"}} {self._errors[name]}'
+                )
+            by_counter = defaultdict(list)
+            for (name, counter), value in self._counters.items():
+                by_counter[counter].append((name, value))
+            for counter in sorted(by_counter):
+                lines.append(f"# TYPE pdf2pod_{counter}_total counter")
+                for name, value in sorted(by_counter[counter]):
+                    lines.append(
+                        f'pdf2pod_{counter}_total{{span="{name}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """Serve `prometheus()` at `/metrics` from a background thread."""
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = recorder.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+recorder = Recorder()
+
+
+def span(name: str, activate: bool = True, **attributes):
+    return recorder.span(name, activate, **attributes)
+
+
+def current_span():
+    """The innermost open span, or a no-op span outside of any."""
+    return _current_span.get() or NOOP_SPAN
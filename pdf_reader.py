@@ -1,14 +1,269 @@
+import os
+import mmap
+import struct
+import hashlib
 import PyPDF2
+import threading
+import multiprocessing
+import metrics
+from uuid import uuid4
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Iterator, Optional
 
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+PAGES_PER_SHARD = 8
 
-def parse_pdf(pdf_path: str) -> str:
-    result = []
+# Bump the suffix whenever extraction output changes
+EXTRACTOR_VERSION = f"pypdf2-{PyPDF2.__version__}.1"
+TEXT_CACHE_DIR = os.getenv("TEXT_CACHE_DIR", os.path.join(".cache", "text"))
+
+_MAGIC = b"P2PPAGE1"
+_TRAILER = struct.Struct("<Q8s")
+
+
+def pdf_digest(pdf_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CachedPages:
+    """
+    Memory-mapped per-page text written by `PageTextCache`.
+
+    Layout: the UTF-8 text of every page back to back, then `count + 1`
+    little-endian uint64 offsets, then the page count and a magic number.
+    Any page range can be read without touching the rest of the file.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        count, magic = _TRAILER.unpack_from(self._map,
+                                            len(self._map) - _TRAILER.size)
+        if magic != _MAGIC:
+            self._map.close()
+            raise ValueError(f"Not a page text cache file: {path}")
+        start = len(self._map) - _TRAILER.size - 8 * (count + 1)
+        self._offsets = struct.unpack_from(f"<{count + 1}Q", self._map, start)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def page_text(self, index: int) -> str:
+        start, stop = self._offsets[index], self._offsets[index + 1]
+        return self._map[start:stop].decode("utf-8", "surrogatepass")
+
+    def iter_pages(self, start: int = 0,
+                   stop: Optional[int] = None) -> Iterator[Dict]:
+        stop = self.count if stop is None else min(stop, self.count)
+        for index in range(start, stop):
+            text = self.page_text(index)
+            content = [{"type": "text", "text": text}] if text else []
+            yield {"page": index + 1, "content": content}
+
+    def close(self):
+        self._map.close()
+
+
+class PageTextCache:
+    """
+    Extracted page text keyed by the SHA-256 of the PDF bytes and the
+    extractor version, so re-uploads of the same file skip extraction.
+    """
+
+    def __init__(self, root: str = TEXT_CACHE_DIR):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, f"{digest}-{EXTRACTOR_VERSION}.pages")
+
+    def get(self, digest: str) -> Optional[CachedPages]:
+        try:
+            pages = CachedPages(self.path(digest))
+        except (FileNotFoundError, ValueError, struct.error):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pages
+
+    def write_through(self, digest: str,
+                      pages: Iterator[Dict]) -> Iterator[Dict]:
+        """
+        Pass `pages` through unchanged while writing them to the cache. The
+        entry only becomes visible once every page has been consumed.
+        """
+        path = self.path(digest)
+        tmp = f"{path}.{uuid4().hex}.tmp"
+        offsets = [0]
+        try:
+            with open(tmp, "wb") as file:
+                for page in pages:
+                    text = "".join(item["text"] for item in page["content"]
+                                   if item["type"] == "text")
+                    offsets.append(offsets[-1] + file.write(
+                        text.encode("utf-8", "surrogatepass")))
+                    yield page
+                count = len(offsets) - 1
+                file.write(struct.pack(f"<{count + 1}Q", *offsets))
+                file.write(_TRAILER.pack(count, _MAGIC))
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+_default_cache = None
+
+
+def default_text_cache() -> PageTextCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = PageTextCache()
+    return _default_cache
+
+
+def _page_content(page_number: int, page) -> Dict:
+    page_content = []
+    text = page.extract_text()
+    if text:
+        page_content.append({"type": "text", "text": text})
+    return {"page": page_number + 1, "content": page_content}
+
+
+def _extract_pages(pdf_path: str, start: int, stop: int) -> List[Dict]:
     with open(pdf_path, 'rb') as file:
         pdf_reader = PyPDF2.PdfReader(file)
-        for page_number, page in enumerate(pdf_reader.pages):
-            page_content = []
-            text = page.extract_text()
-            if text:
-                page_content.append({"type": "text", "text": text})
-            result.append({"page": page_number + 1, "content": page_content})
-    return result
+        return [
+            _page_content(page_number, pdf_reader.pages[page_number])
+            for page_number in range(start, stop)
+        ]
+
+
+def page_count(pdf_path: str) -> int:
+    with open(pdf_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def iter_pdf_pages(pdf_path: str,
+                   workers: Optional[int] = None,
+                   pages_per_shard: int = PAGES_PER_SHARD,
+                   cache: Optional[PageTextCache] = None,
+                   start: int = 0,
+                   stop: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Yield pages `start` to `stop` in order as they are extracted.
+
+    Text already extracted from a PDF with the same content is read from the
+    page text cache instead; otherwise a full extraction fills the cache.
+
+    Documents longer than one shard are split into page ranges extracted by a
+    process pool. Only a couple of shards per worker are in flight at a time,
+    so memory stays bounded and callers can start on the first pages while
+    later ones are still being parsed.
+    """
+    cache = cache or default_text_cache()
+    digest = pdf_digest(pdf_path)
+    cached = cache.get(digest)
+    metrics.current_span().add(
+        "text_cache_hits" if cached is not None else "text_cache_misses")
+    if cached is not None:
+        try:
+            yield from cached.iter_pages(start, stop)
+        finally:
+            cached.close()
+        return
+    pages = _extract_pdf_pages(pdf_path, workers, pages_per_shard, start,
+                               stop)
+    if start == 0 and stop is None:
+        pages = cache.write_through(digest, pages)
+    yield from pages
+
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def extraction_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    The process pool of `workers` that extracts page ranges, created on
+    first use and shared by every extraction after it, so workers start once
+    per process rather than once per document.
+
+    Workers are forked from a server process that has preloaded this module
+    where the platform allows it, and spawned otherwise; forking the caller
+    directly would copy threads (the event loop's worker pool, HTTP clients)
+    mid-operation. Either way each worker imports the main script once, so
+    it must keep its side effects behind `if __name__ == "__main__"`.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            pool = _pools[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=context)
+        return pool
+
+
+def _discard_pool(workers: int, pool: ProcessPoolExecutor):
+    with _pools_lock:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_pdf_pages(pdf_path: str, workers: Optional[int],
+                       pages_per_shard: int, first: int,
+                       last: Optional[int]) -> Iterator[Dict]:
+    workers = workers or PDF_WORKERS
+    total = page_count(pdf_path)
+    last = total if last is None else min(last, total)
+    if workers <= 1 or last - first <= pages_per_shard:
+        with open(pdf_path, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            for page_number in range(first, last):
+                yield _page_content(page_number,
+                                    pdf_reader.pages[page_number])
+        return
+
+    shards = ((start, min(start + pages_per_shard, last))
+              for start in range(first, last, pages_per_shard))
+    pool = extraction_pool(workers)
+    pending = deque()
+
+    def submit_next():
+        shard = next(shards, None)
+        if shard is not None:
+            pending.append(pool.submit(_extract_pages, pdf_path, *shard))
+
+    try:
+        for _ in range(workers * 2):
+            submit_next()
+        while pending:
+            pages = pending.popleft().result()
+            submit_next()
+            yield from pages
+    except BrokenProcessPool:
+        # A worker died; the next extraction starts a fresh pool
+        _discard_pool(workers, pool)
+        raise
+    finally:
+        # Shards of a caller that stopped reading are not needed any more
+        for future in pending:
+            future.cancel()
+
+
+def parse_pdf(pdf_path: str, workers: Optional[int] = None) -> List[Dict]:
+    return list(iter_pdf_pages(pdf_path, workers))
@@ -1,22 +1,59 @@
 import os
 import json
-from dialogue import generate_dialogue
-from pdf_reader import parse_pdf
-from typing import List, Dict, Union
-from voiceover import generate_voice_clips, join_audio_clips
+import asyncio
+import metrics
+from checkpoint import RunCheckpoint, file_digest
+from chunking import iter_sections
+from concurrency import AdaptiveLimiter, prioritize
+from pdf_reader import iter_pdf_pages, pdf_digest
+from preprocess import TEXT_PREPROCESS, clean_pages
+from typing import Any, List, Dict, Set, Tuple, Union, Optional, Iterator, Callable
+
+
+def iter_pdf_text(pdf_path: str) -> Iterator[str]:
+    """Yield the text of each page in order while extraction continues."""
+    for page in iter_pdf_pages(pdf_path):
+        for item in page["content"]:
+            if item["type"] == "text":
+                yield item["text"]
 
 
 def parse_pdf_to_text(pdf_path: str):
-    text = parse_pdf(pdf_path)
-    text = list(
-        filter(lambda t: [t for t in t if t["type"] == "text"],
-               list(map(lambda x: x["content"], text))))
+    return "\n".join(iter_pdf_text(pdf_path))
+
+
+def extract_text(pdf_path: str, preprocess: bool = TEXT_PREPROCESS) -> str:
+    """The text of the PDF, stripped of boilerplate unless disabled."""
+    if not preprocess:
+        return parse_pdf_to_text(pdf_path)
+    text, stats = clean_pages(list(iter_pdf_text(pdf_path)))
+    span = metrics.current_span()
+    for counter, value in stats.items():
+        span.add(counter, value)
+    print(f"Preprocessing removed {stats['boilerplate_lines']} boilerplate "
+          f"and {stats['reference_lines']} reference lines, saving "
+          f"{stats['tokens_saved']} of {stats['tokens_before']} tokens")
+    return text
 
-    flatten = [item for sublist in text for item in sublist]
-    flattent = list(
-        map(lambda x: x["text"],
-            list(filter(lambda t: t["type"] == "text", flatten))))
-    return "\n".join(flattent)
+
+def extract_sections(pdf_path: str, max_tokens: int) -> Tuple[str, List[str]]:
+    """
+    The raw text of the PDF and its sections of at most `max_tokens` tokens,
+    packed while later pages are still being parsed. Only for unprocessed
+    text: removing boilerplate needs every page first.
+    """
+    pages = []
+
+    def parsed():
+        for page in iter_pdf_text(pdf_path):
+            pages.append(page)
+            yield page
+
+    sections = [
+        section for section in iter_sections(parsed(), max_tokens)
+        if section.strip()
+    ]
+    return "\n".join(pages), sections
 
 
 def add_dialogue_ids(dialogue: List[Dict]):
@@ -38,15 +75,288 @@ def add_dialogue_ids(dialogue: List[Dict]):
     return dialogue, speakers
 
 
+# Requests from later stages go first on shared limiters, so work that is
+# nearly done is not held up by documents that have only just started
+STAGE_RANKS = {
+    "parsing": 0,
+    "scratchpad": 1,
+    "dialogue": 2,
+    "dialogue+voice_clips": 3,
+    "voice_clips": 3,
+    "joining": 4,
+}
+
+
+def verified_clips(clips: Dict[str, str], path: str) -> Set[str]:
+    """Clip files in `path` that still match their digest in `clips`."""
+    verified = set()
+    for name, digest in clips.items():
+        filename = os.path.join(path, name)
+        if os.path.exists(filename) and file_digest(filename) == digest:
+            verified.add(filename)
+    return verified
+
+
+def prune_clips(clips: Dict[str, str], dialogue: List[Dict],
+                path: str) -> Dict[str, str]:
+    """The entries of `clips` for lines of `dialogue`, dropping stale ones."""
+    from voiceover import get_clip_filename
+    names = {
+        os.path.basename(
+            get_clip_filename(line.get("speaker"), line.get("text"), path))
+        for turn in dialogue
+        for line in [turn] + list(turn.get("overlaps") or [])
+    }
+    return {name: digest for name, digest in clips.items() if name in names}
+
+
+def previous_render(checkpoint: RunCheckpoint,
+                    path: str) -> Optional[Dict[str, Any]]:
+    """
+    The record of the last render in `path` if `rerender_episode` can reuse
+    it, even if the run has changed since: it lists its turns and its WAV
+    master is intact.
+    """
+    render = checkpoint.load("render", partial=True)
+    if render is None or "turns" not in render:
+        return None
+    master = os.path.join(path, render["master"])
+    if not os.path.exists(master) or file_digest(
+            master) != render["master_sha256"]:
+        return None
+    return render
+
+
 async def generate_podcast(pdf_path: str,
                            path: str = "audio_clips_1",
-                           user_instruction: str = ""):
-    text = parse_pdf_to_text(pdf_path)
-    print(f"TEXT: {text}")
-    dialogue = await generate_dialogue(text, user_instruction)
-    dialogue, speakers = add_dialogue_ids(dialogue)
-    speakers = list(speakers)
-    print(f"SPEAKERS: {json.dumps(speakers)}")
-    print(f"DIALOGUE: \n{json.dumps(dialogue, indent=2)}")
-    await generate_voice_clips(dialogue, path)
-    join_audio_clips(dialogue, path, os.path.join(path, "full_podcast.wav"))
+                           user_instruction: str = "",
+                           stream: bool = False,
+                           long_document: Optional[bool] = None,
+                           on_stage: Optional[Callable[[str], None]] = None,
+                           on_audio: Optional[Callable[[str], None]] = None,
+                           resume: bool = False,
+                           output_format: str = "wav",
+                           tts_limiter: Optional[AdaptiveLimiter] = None
+                           ) -> str:
+    """
+    Turn a PDF into `<path>/full_podcast.<output_format>` (wav, mp3 or opus)
+    and return its path. With `on_audio`, the episode
+    is rendered as its clips arrive and each finished chunk's path is passed
+    to `on_audio` in playback order.
+
+    Every stage is checkpointed in `path`. With `resume`, stages completed
+    by an earlier run with the same inputs are skipped and only missing or
+    corrupt clips are synthesized again. If the inputs changed, only the
+    turns of the new dialogue that differ from the last render are mixed
+    again (see `rerender_episode`). Pass `tts_limiter` to share one
+    ElevenLabs budget between concurrent runs.
+    """
+    # The LLM and audio stacks are slow to import; only load them for a run
+    from dialogue import DIALOGUE_MODEL, SECTION_TOKENS, generate_dialogue, generate_dialogue_stream, plan_dialogue
+    from voiceover import TTS_MODEL, generate_voice_clips, generate_voice_clips_stream, join_audio_clips, rerender_episode, ProgressiveJoin
+
+    report_stage = on_stage or (lambda stage: None)
+
+    def on_stage(stage):
+        prioritize(STAGE_RANKS.get(stage, 0))
+        report_stage(stage)
+
+    os.makedirs(path, exist_ok=True)
+    output_file = os.path.join(path, f"full_podcast.{output_format}")
+    checkpoint = RunCheckpoint(path)
+    previous = await asyncio.to_thread(previous_render, checkpoint,
+                                       path) if resume else None
+    # The run is identified by the PDF's content, not where it was read from,
+    # so a moved or re-uploaded copy still resumes
+    checkpoint.start(
+        {
+            "pdf_sha256": await asyncio.to_thread(pdf_digest, pdf_path),
+            "user_instruction": user_instruction,
+            "long_document": long_document,
+            "preprocess": TEXT_PREPROCESS,
+            "dialogue_model": DIALOGUE_MODEL,
+            "tts_model": TTS_MODEL,
+        },
+        resume=resume,
+        metadata={"pdf_path": os.path.abspath(pdf_path)})
+
+    render = checkpoint.load("render")
+    if render is not None and render["file"] == os.path.basename(
+            output_file) and os.path.exists(
+                output_file) and await asyncio.to_thread(
+                    file_digest, output_file) == render["sha256"]:
+        print(f"Already rendered: {output_file}")
+        on_stage("done")
+        if on_audio:
+            on_audio(output_file)
+        return output_file
+
+    clips = checkpoint.load("clips", partial=True) or {}
+    verified = await asyncio.to_thread(verified_clips, clips, path)
+    if verified:
+        print(f"Reusing {len(verified)} verified clips")
+
+    async def on_clip(filename):
+        clips[os.path.basename(filename)] = await asyncio.to_thread(
+            file_digest, filename)
+        checkpoint.save("clips", clips, complete=False)
+
+    with metrics.span("podcast", path=path, stream=stream) as run:
+        on_stage("parsing")
+        text = checkpoint.load("text")
+        sections = None
+        if text is None:
+            with metrics.span("parse_pdf"):
+                if TEXT_PREPROCESS or long_document is False:
+                    text = await asyncio.to_thread(extract_text, pdf_path)
+                else:
+                    # Long documents are planned section by section, so
+                    # chunk the pages while they are parsed
+                    text, sections = await asyncio.to_thread(
+                        extract_sections, pdf_path, SECTION_TOKENS)
+            checkpoint.save("text", text)
+        print(f"TEXT: {text}")
+
+        join = ProgressiveJoin(path, output_file,
+                               on_audio) if on_audio else None
+        on_turn = join.add_turn if join else None
+        try:
+            dialogue = checkpoint.load("dialogue")
+            if dialogue is None:
+                plan = checkpoint.load("scratchpad")
+                if plan is None:
+                    on_stage("scratchpad")
+                    plan = await plan_dialogue(text, user_instruction,
+                                               long_document, sections)
+                    checkpoint.save("scratchpad", plan)
+                if stream:
+                    on_stage("dialogue+voice_clips")
+
+                    async def turns():
+                        received = []
+                        async for turn in generate_dialogue_stream(
+                                text, user_instruction, long_document, plan):
+                            received.append(turn)
+                            yield turn
+                        checkpoint.save("dialogue", {"dialogue": received})
+
+                    # Synthesize each turn while the rest of the dialogue is generated
+                    with metrics.span("dialogue+voice_clips"):
+                        dialogue = await generate_voice_clips_stream(
+                            turns(),
+                            path,
+                            on_turn=on_turn,
+                            verified=verified,
+                            on_clip=on_clip,
+                            limiter=tts_limiter)
+                    dialogue = {"dialogue": dialogue}
+                else:
+                    on_stage("dialogue")
+                    with metrics.span("dialogue"):
+                        dialogue = await generate_dialogue(
+                            text, user_instruction, long_document, plan)
+                    checkpoint.save("dialogue", dialogue)
+            else:
+                # The dialogue is known, so there is nothing left to stream
+                stream = False
+            dialogue, speakers = add_dialogue_ids(dialogue)
+            speakers = list(speakers)
+            print(f"SPEAKERS: {json.dumps(speakers)}")
+            print(f"DIALOGUE: \n{json.dumps(dialogue, indent=2)}")
+            if not stream:
+                on_stage("voice_clips")
+                with metrics.span("voice_clips", reused=len(verified)):
+                    await generate_voice_clips(dialogue,
+                                               path,
+                                               on_turn=on_turn,
+                                               verified=verified,
+                                               on_clip=on_clip,
+                                               limiter=tts_limiter)
+        except BaseException:
+            # Also on cancellation, so no half-written episode is left open
+            if join is not None:
+                join.abort()
+            raise
+        checkpoint.save("clips", clips)
+        on_stage("joining")
+        with metrics.span("join"):
+            if join is not None:
+                record = await join.finish()
+            elif previous is not None:
+                record = await asyncio.to_thread(rerender_episode, dialogue,
+                                                 path, output_file, previous)
+            else:
+                record = await asyncio.to_thread(join_audio_clips, dialogue,
+                                                 path, output_file)
+        digest = await asyncio.to_thread(file_digest, output_file)
+        master = os.path.join(path, record["master"])
+        checkpoint.save(
+            "render", {
+                "file": os.path.basename(output_file),
+                "sha256": digest,
+                **record,
+                "master_sha256": digest if master == output_file else
+                await asyncio.to_thread(file_digest, master)
+            })
+        # Edits leave digests of clips the dialogue no longer uses
+        checkpoint.save("clips", prune_clips(clips, dialogue, path))
+    if metrics.recorder.enabled:
+        metrics.recorder.write_report(run,
+                                      os.path.join(path, "run_report.json"))
+    return output_file
+
+
+async def resume_podcast(path: str, **kwargs) -> str:
+    """
+    Finish an interrupted `generate_podcast` run in `path`, reusing every
+    stage it completed.
+    """
+    checkpoint = RunCheckpoint(path)
+    inputs = checkpoint.inputs
+    if not inputs:
+        raise ValueError(f"No run to resume in {path}")
+    # Runs checkpointed before the path moved to the metadata kept it in the
+    # inputs
+    pdf_path = checkpoint.metadata.get("pdf_path") or inputs["pdf_path"]
+    return await generate_podcast(pdf_path,
+                                  path,
+                                  inputs["user_instruction"],
+                                  long_document=inputs["long_document"],
+                                  resume=True,
+                                  **kwargs)
+
+
+async def edit_podcast(path: str, dialogue: Dict[str, Any],
+                       **kwargs) -> str:
+    """
+    Replace the dialogue of the run in `path` with an edited `dialogue`
+    (`{"dialogue": [...]}`, like the generated one) and render it again.
+
+    Only turns whose clips changed are synthesized, counting a change to the
+    previous_text context a turn's first line takes from the line before,
+    and only those turns are mixed again. Takes the keyword arguments of
+    `generate_podcast`.
+    """
+    from voiceover import get_clip_filename, turn_keys
+    checkpoint = RunCheckpoint(path)
+    if checkpoint.load("dialogue") is None:
+        raise ValueError(f"No dialogue to edit in {path}")
+    previous = checkpoint.load("render", partial=True) or {}
+    old_keys = {turn["key"] for turn in previous.get("turns", [])}
+    lines = dialogue["dialogue"]
+    clips = checkpoint.load("clips", partial=True) or {}
+    for turn, key in zip(lines, turn_keys(lines)):
+        if key in old_keys:
+            continue
+        # Same file name, but the clip may need new previous_text context
+        for line in [turn] + list(turn.get("overlaps") or []):
+            clips.pop(
+                os.path.basename(
+                    get_clip_filename(line.get("speaker"), line.get("text"),
+                                      path)), None)
+    checkpoint.save("dialogue", dialogue)
+    checkpoint.save("clips", clips, complete=False)
+    if previous:
+        # Kept as the starting point for the re-render, but no longer final
+        checkpoint.save("render", previous, complete=False)
+    return await resume_podcast(path, **kwargs)
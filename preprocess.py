@@ -0,0 +1,181 @@
+import os
+import re
+import math
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from chunking import count_tokens
+
+TEXT_PREPROCESS = os.getenv("TEXT_PREPROCESS", "1") == "1"
+
+# Lines at the top and bottom of a page that may be running headers/footers
+EDGE_LINES = 3
+# A line repeated at the edge of this share of pages is boilerplate
+REPEAT_FRACTION = 0.3
+MIN_REPEATS = 3
+SHORT_LINE_WORDS = 8
+
+_PAGE_NUMBER = re.compile(
+    r"^(?:page\s*)?(\d+|[ivxlc]+)(?:\s*(?:of|/)\s*\d+)?$|^[-–]\s*(\d+)\s*[-–]$",
+    re.IGNORECASE)
+_ROMAN = re.compile(r"^(?=[ivxlc])c{0,3}(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$")
+_ROMAN_VALUES = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100}
+_REFERENCES = re.compile(
+    r"^(\d+(\.\d+)*\.?\s+|[ivx]+\.\s+)?(references|bibliography|works cited|literature cited)$",
+    re.IGNORECASE)
+_APPENDIX = re.compile(r"^(appendix|appendices|supplementary material)\b",
+                       re.IGNORECASE)
+_HYPHEN_BREAK = re.compile(r"(\w+)-\n+([a-z]\w*)")
+_WORD = re.compile(r"\w+(?:-\w+)*")
+_SPACES = re.compile(r"[ \t\f\v ]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def _signature(line: str) -> str:
+    line = _SPACES.sub(" ", line).strip().lower()
+    # Short headers often differ only in the page number; longer lines must
+    # repeat exactly, so numbered body text is never mistaken for one
+    if len(line.split()) <= SHORT_LINE_WORDS:
+        line = re.sub(r"\d+", "#", line)
+    return line
+
+
+def _page_number(line: str) -> Optional[Tuple[str, int]]:
+    """
+    Numbering style and value of a line that is only a page number, such as
+    "12", "Page 3 of 9", "- 4 -" or "iv".
+    """
+    match = _PAGE_NUMBER.match(line.strip())
+    if match is None:
+        return None
+    number = (match.group(1) or match.group(2)).lower()
+    if number.isdigit():
+        return "arabic", int(number)
+    if not _ROMAN.match(number):
+        return None
+    values = [_ROMAN_VALUES[char] for char in number]
+    return "roman", sum(-value if value < after else value
+                        for value, after in zip(values, values[1:] + [0]))
+
+
+def _edges(lines: List[str]) -> Tuple[List[int], List[int]]:
+    content = [ix for ix, line in enumerate(lines) if line.strip()]
+    return content[:EDGE_LINES], content[-EDGE_LINES:]
+
+
+def strip_repeated_lines(pages: List[List[str]]) -> int:
+    """
+    Drop running headers, footers and page numbers from `pages` (lists of
+    lines) in place. Returns the number of lines removed.
+
+    A bare number only counts as a page number when it follows the page
+    sequence: its value minus the page's index is the same on several
+    pages. Other numbers at the edge of a page, such as table cells or
+    years, are kept.
+    """
+    threshold = max(MIN_REPEATS, math.ceil(REPEAT_FRACTION * len(pages)))
+    sequence = min(MIN_REPEATS, len(pages))
+    counts = [Counter(), Counter()]
+    offsets = Counter()
+    for index, lines in enumerate(pages):
+        page_offsets = set()
+        for count, edge in zip(counts, _edges(lines)):
+            signatures = set()
+            for ix in edge:
+                number = _page_number(lines[ix])
+                if number is None:
+                    signatures.add(_signature(lines[ix]))
+                else:
+                    page_offsets.add((number[0], number[1] - index))
+            count.update(signatures)
+        offsets.update(page_offsets)
+
+    def boilerplate(count, index, line):
+        number = _page_number(line)
+        if number is None:
+            return count[_signature(line)] >= threshold
+        return sequence > 1 and offsets[(number[0],
+                                         number[1] - index)] >= sequence
+
+    removed = 0
+    for index, lines in enumerate(pages):
+        drop = set()
+        for count, edge in zip(counts, _edges(lines)):
+            drop.update(ix for ix in edge
+                        if boilerplate(count, index, lines[ix]))
+        for ix in sorted(drop, reverse=True):
+            del lines[ix]
+        removed += len(drop)
+    return removed
+
+
+def strip_references(lines: List[str]) -> int:
+    """
+    Drop the reference section: from the last "References" heading in the
+    second half of the document up to an appendix, if any. Returns the
+    number of lines removed.
+    """
+    start = None
+    for ix in range(len(lines) - 1, len(lines) // 2 - 1, -1):
+        if _REFERENCES.match(lines[ix].strip()):
+            start = ix
+            break
+    if start is None:
+        return 0
+    stop = len(lines)
+    for ix in range(start + 1, len(lines)):
+        if _APPENDIX.match(lines[ix].strip()):
+            stop = ix
+            break
+    del lines[start:stop]
+    return stop - start
+
+
+def rejoin_hyphenated(text: str) -> str:
+    """
+    Rejoin words hyphenated across a line break. The document's own words
+    decide: the hyphen is dropped if the joined word occurs elsewhere in
+    the text, kept if the hyphenated word does or the part before the
+    hyphen is a word on its own (as in "well-known"), and dropped
+    otherwise.
+    """
+    vocabulary = set()
+    for word in _WORD.findall(_HYPHEN_BREAK.sub(" ", text)):
+        word = word.lower()
+        vocabulary.add(word)
+        vocabulary.update(word.split("-"))
+
+    def join(match):
+        before, after = match.groups()
+        joined = (before + after).lower()
+        hyphenated = f"{before}-{after}".lower()
+        if joined in vocabulary or (hyphenated not in vocabulary and
+                                    before.lower() not in vocabulary):
+            return before + after
+        return f"{before}-{after}"
+
+    return _HYPHEN_BREAK.sub(join, text)
+
+
+def clean_pages(pages: List[str]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Remove boilerplate from the text of each page and join it into one text.
+
+    Drops lines repeated at the top or bottom of many pages, page numbers
+    and the reference section, rejoins words hyphenated across lines and
+    collapses whitespace. Returns the text with token counts before and
+    after.
+    """
+    raw = "\n".join(pages)
+    page_lines = [page.split("\n") for page in pages]
+    stats = {"boilerplate_lines": strip_repeated_lines(page_lines)}
+    lines = [line for page in page_lines for line in page]
+    stats["reference_lines"] = strip_references(lines)
+
+    text = "\n".join(_SPACES.sub(" ", line).strip() for line in lines)
+    text = rejoin_hyphenated(text)
+    text = _BLANK_LINES.sub("\n\n", text).strip()
+
+    stats["tokens_before"] = count_tokens(raw)
+    stats["tokens_after"] = count_tokens(text)
+    stats["tokens_saved"] = stats["tokens_before"] - stats["tokens_after"]
+    return text, stats
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import threading
+from uuid import uuid4
+from collections import Counter
+from typing import Dict, Any
+from clip_store import TMP_SUFFIX, atomic_write
+
+RUNS_DIR = os.getenv("RUNS_DIR", "runs")
+RUNS_MAX_BYTES = int(os.getenv("RUNS_MAX_BYTES", 10 * 1024**3))
+# Runs not used for this many seconds are deleted
+RUN_TTL = float(os.getenv("RUN_TTL", 7 * 24 * 3600))
+RUNS_SWEEP_INTERVAL = float(os.getenv("RUNS_SWEEP_INTERVAL", 600))
+
+INDEX_FILE = "index.json"
+# Suffix of a run renamed out of the way while it is deleted
+EVICTING_SUFFIX = ".evicting"
+
+
+def run_bytes(path: str) -> int:
+    """
+    Bytes that deleting the run directory `path` would free. Files hard-linked
+    from the clip store are still referenced by it, so they are not counted.
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink == 1:
+                total += stat.st_size
+    return total
+
+
+class RunStore:
+    """
+    Run directories of the app, kept under `root` within a byte quota.
+
+    `index.json` records each run's size and when it was last used, so
+    startup does not walk every run. Runs unused for `ttl` seconds are
+    deleted, then least recently used runs until the total fits in
+    `max_bytes`. Runs held with `acquire` are never deleted, and neither
+    are the clip store's files that runs link to.
+
+    `acquire`, `release` and `touch` only update the index in memory; sizes
+    are measured and runs deleted by `sweep`, which `start` runs
+    periodically on a background thread.
+    """
+
+    def __init__(self,
+                 root: str = RUNS_DIR,
+                 max_bytes: int = RUNS_MAX_BYTES,
+                 ttl: float = RUN_TTL,
+                 interval: float = RUNS_SWEEP_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.interval = interval
+        self.evictions = 0
+        self.expirations = 0
+        self.freed_bytes = 0
+        self._runs: Dict[str, Dict[str, Any]] = {}
+        self._pins = Counter()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._task = None
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, INDEX_FILE)
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                self._runs = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print(f"Ignoring unreadable run index: {self.index_path}")
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(EVICTING_SUFFIX):
+                # Left behind by a sweep that was interrupted
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(TMP_SUFFIX):
+                os.remove(path)
+            elif os.path.isdir(path) and name not in self._runs:
+                self._runs[name] = {"bytes": 0, "last_used": now}
+                self._dirty.add(name)
+        for name in list(self._runs):
+            if not os.path.isdir(os.path.join(self.root, name)):
+                del self._runs[name]
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def acquire(self, name: str) -> str:
+        """Create or reuse the run `name` and keep it until `release`."""
+        with self._lock:
+            self._pins[name] += 1
+            self._used(name)
+        path = self.path(name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def release(self, name: str):
+        with self._lock:
+            self._pins[name] -= 1
+            if self._pins[name] <= 0:
+                del self._pins[name]
+            self._used(name)
+
+    def touch(self, name: str):
+        """Mark the run `name` as used now and measure it on the next sweep."""
+        with self._lock:
+            self._used(name)
+
+    def _used(self, name: str):
+        run = self._runs.setdefault(name, {"bytes": 0})
+        run["last_used"] = time.time()
+        self._dirty.add(name)
+
+    def total_bytes(self) -> int:
+        return sum(run["bytes"] for run in self._runs.values())
+
+    def sweep(self) -> int:
+        """
+        Measure runs used since the last sweep, then delete expired runs
+        and least recently used ones until the quota is met. Returns the
+        number of runs deleted.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        sizes = {name: run_bytes(self.path(name)) for name in dirty}
+
+        victims = []
+        with self._lock:
+            for name, size in sizes.items():
+                if name in self._runs:
+                    self._runs[name]["bytes"] = size
+            now = time.time()
+            total = self.total_bytes()
+            for name, run in sorted(self._runs.items(),
+                                    key=lambda item: item[1]["last_used"]):
+                expired = now - run["last_used"] > self.ttl
+                if not expired and total <= self.max_bytes:
+                    break
+                if self._pins[name] or name in self._dirty:
+                    continue
+                victims.append([name, run["bytes"], expired])
+                total -= run["bytes"]
+            for victim in victims:
+                name = victim[0]
+                del self._runs[name]
+                # Renamed under the lock, so a run acquired from now on
+                # starts in a fresh directory
+                doomed = f"{self.path(name)}.{uuid4().hex}{EVICTING_SUFFIX}"
+                try:
+                    os.replace(self.path(name), doomed)
+                except FileNotFoundError:
+                    continue
+                victim.append(doomed)
+            index = json.dumps(self._runs)
+        atomic_write(self.index_path, index.encode("utf-8"))
+
+        for name, size, expired, *doomed in victims:
+            for path in doomed:
+                shutil.rmtree(path, ignore_errors=True)
+            self.freed_bytes += size
+            if expired:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+        if victims:
+            print(f"Deleted {len(victims)} runs, freeing "
+                  f"{sum(victim[1] for victim in victims)} bytes")
+        return len(victims)
+
+    async def _sweep_forever(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"Run cleanup failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Sweep every `interval` seconds on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(
+                self._sweep_forever())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "runs": len(self._runs),
+                "live": len(self._pins),
+                "bytes": self.total_bytes(),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "freed_bytes": self.freed_bytes,
+            }
+
+
+_default_store = None
+
+
+def default_run_store() -> RunStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = RunStore()
+    return _default_store
@@ -0,0 +1,144 @@
+import time
+import asyncio
+from uuid import uuid4
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class Job:
+
+    def __init__(self, key: str, fn: Callable[..., Awaitable[Any]], args,
+                 kwargs):
+        self.id = str(uuid4())
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.stage = "queued"
+        self.waiters = 1
+        self.outputs = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = asyncio.get_running_loop().create_future()
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+
+    def publish(self, output: Any):
+        self.outputs.append(output)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "waiters": self.waiters,
+            "queued_for": (self.started or time.time()) - self.created,
+            "running_for":
+            (self.finished or time.time()) - self.started
+            if self.started else 0.0,
+        }
+
+
+class JobScheduler:
+    """
+    Runs jobs on a fixed number of workers behind a bounded queue.
+
+    Submitting a job whose key matches a queued or running job attaches to
+    that job instead of starting another, so identical requests share one
+    execution. When the queue is full, `submit` raises `QueueFullError`.
+    The job function receives the job's `set_stage` as `on_stage` to report
+    progress and its `publish` as `on_output` to hand out partial results,
+    which every waiter can read from `job.outputs`.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 16):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.jobs: Dict[str, Job] = {}
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self._queue = None
+        self._tasks = []
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._tasks = [
+                asyncio.create_task(self._worker())
+                for _ in range(self.workers)
+            ]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            try:
+                result = await job.fn(*job.args,
+                                      on_stage=job.set_stage,
+                                      on_output=job.publish,
+                                      **job.kwargs)
+            except Exception as e:
+                job.status = "failed"
+                self.failed += 1
+                job.future.set_exception(e)
+            else:
+                job.status = "done"
+                self.completed += 1
+                job.future.set_result(result)
+            finally:
+                job.finished = time.time()
+                job.stage = job.status
+                self.jobs.pop(job.key, None)
+                self._queue.task_done()
+
+    def submit(self, key: str, fn: Callable[..., Awaitable[Any]], *args,
+               **kwargs) -> Job:
+        self._start()
+        job = self.jobs.get(key)
+        if job is not None:
+            job.waiters += 1
+            self.deduplicated += 1
+            return job
+        job = Job(key, fn, args, kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(
+                f"Job queue is full ({self.max_queue} waiting)") from None
+        self.jobs[key] = job
+        return job
+
+    async def wait(self, job: Job) -> Any:
+        # Shielded so one cancelled waiter does not cancel a shared job
+        return await asyncio.shield(job.future)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def position(self, job: Job) -> Optional[int]:
+        """Number of queued jobs ahead of `job`, or None once it started."""
+        if job.status != "queued":
+            return None
+        queued = [j for j in self.jobs.values() if j.status == "queued"]
+        queued.sort(key=lambda j: j.created)
+        return queued.index(job)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth(),
+            "running":
+            sum(1 for job in self.jobs.values() if job.status == "running"),
+            "completed": self.completed,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "jobs": [job.info() for job in self.jobs.values()],
+        }
@@ -0,0 +1,77 @@
+import os
+from checkpoint import RunCheckpoint
+
+INPUTS = {"pdf_sha256": "abc", "instruction": "", "preprocess": True}
+
+
+def test_resume_with_same_inputs(tmp_path):
+    run = RunCheckpoint(str(tmp_path))
+    run.start(INPUTS, metadata={"pdf_path": "/tmp/a.pdf"})
+    run.save("text", ["page one"])
+    run.save("scratchpad", "ideas")
+
+    resumed = RunCheckpoint(str(tmp_path))
+    resumed.start(dict(INPUTS), metadata={"pdf_path": "/tmp/moved.pdf"})
+    assert resumed.completed() == ["text", "scratchpad"]
+    assert resumed.load("text") == ["page one"]
+    assert resumed.load("scratchpad") == "ideas"
+    assert resumed.load("dialogue") is None
+    # Metadata is updated without invalidating anything
+    assert resumed.metadata == {"pdf_path": "/tmp/moved.pdf"}
+
+
+def test_changed_inputs_start_over(tmp_path):
+    run = RunCheckpoint(str(tmp_path))
+    run.start(INPUTS)
+    run.save("text", ["page one"])
+
+    changed = RunCheckpoint(str(tmp_path))
+    changed.start({**INPUTS, "instruction": "focus on methods"})
+    assert changed.completed() == []
+    assert changed.load("text") is None
+
+
+def test_no_resume_starts_over(tmp_path):
+    run = RunCheckpoint(str(tmp_path))
+    run.start(INPUTS)
+    run.save("text", ["page one"])
+
+    fresh = RunCheckpoint(str(tmp_path))
+    fresh.start(INPUTS, resume=False)
+    assert fresh.load("text") is None
+
+
+def test_partial_progress_only_on_request(tmp_path):
+    run = RunCheckpoint(str(tmp_path))
+    run.start(INPUTS)
+    run.save("clips", {"0": "digest"}, complete=False)
+
+    resumed = RunCheckpoint(str(tmp_path))
+    resumed.start(INPUTS)
+    assert resumed.load("clips") is None
+    assert resumed.load("clips", partial=True) == {"0": "digest"}
+    assert "clips" not in resumed.completed()
+
+
+def test_corrupt_or_missing_checkpoint_is_redone(tmp_path):
+    run = RunCheckpoint(str(tmp_path))
+    run.start(INPUTS)
+    run.save("text", ["page one"])
+    run.save("dialogue", [{"speaker": "A", "text": "Hi"}])
+    with open(os.path.join(tmp_path, "checkpoints", "text.json"), "w") as f:
+        f.write('["tampered"]')
+    os.remove(os.path.join(tmp_path, "checkpoints", "dialogue.json"))
+
+    resumed = RunCheckpoint(str(tmp_path))
+    resumed.start(INPUTS)
+    assert resumed.load("text") is None
+    assert resumed.load("dialogue") is None
+
+
+def test_unreadable_manifest_starts_over(tmp_path):
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        f.write("{not json")
+    run = RunCheckpoint(str(tmp_path))
+    run.start(INPUTS)
+    assert run.completed() == []
+    assert run.inputs == INPUTS
@@ -0,0 +1,84 @@
+import pytest
+import preprocess
+from preprocess import clean_pages
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # Token counts only feed the stats; keep tiktoken's encodings out of it
+    monkeypatch.setattr(preprocess, "count_tokens",
+                        lambda text: len(text.split()))
+
+
+BODY = [
+    "Transformers replaced recurrent networks.",
+    "Attention weighs every token against the others.",
+    "Training needs large corpora.",
+    "Evaluation used held out benchmarks.",
+    "Results improved on every task.",
+    "Limitations remain for long inputs.",
+]
+
+
+def page(body, header="Journal of Examples, Vol. 3", number=None):
+    lines = [header, *body]
+    if number is not None:
+        lines.append(str(number))
+    return "\n".join(lines)
+
+
+def test_drops_running_headers_and_page_numbers():
+    pages = [page([body], number=index + 1) for index, body in enumerate(BODY)]
+    text, stats = clean_pages(pages)
+    assert "Journal of Examples" not in text
+    assert text.split("\n") == BODY
+    assert stats["boilerplate_lines"] == 12
+    assert stats["tokens_saved"] == stats["tokens_before"] - stats[
+        "tokens_after"] > 0
+
+
+def test_keeps_numbers_that_do_not_follow_the_pages():
+    # Table cells and years at the edge of a page are not page numbers
+    pages = [
+        page(["Revenue grew steadily.", "98"]),
+        page(["The study ran until", "2019"]),
+        page(["Results follow.", "I"]),
+        page(["More results."]),
+    ]
+    text, _ = clean_pages(pages)
+    lines = text.split("\n")
+    assert "98" in lines
+    assert "2019" in lines
+    assert "I" in lines
+
+
+def test_roman_page_numbers_in_sequence():
+    pages = [
+        page([body], number=number)
+        for body, number in zip(BODY, ["i", "ii", "iii", "iv"])
+    ]
+    text, _ = clean_pages(pages)
+    assert text.split("\n") == BODY[:4]
+
+
+def test_rejoins_hyphenated_words():
+    pages = [
+        "The experi-\nment was repeated.\nEach experiment took a day.",
+        "A well-\nknown method was used.\nIt worked well.",
+    ]
+    text, _ = clean_pages(pages)
+    assert "The experiment was repeated." in text
+    assert "A well-known method was used." in text
+
+
+def test_drops_reference_section_up_to_appendix():
+    pages = [
+        "Introduction\nSome findings.\nMore findings.",
+        "Discussion\nWhat it means.",
+        "References\n[1] A. Author. A paper. 2001.\n[2] B. Author. 2002.",
+        "Appendix A\nExtra tables.",
+    ]
+    text, stats = clean_pages(pages)
+    assert "A. Author" not in text
+    assert "Appendix A\nExtra tables." in text
+    assert stats["reference_lines"] == 3
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from scheduler import JobScheduler, QueueFullError
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_same_key_shares_one_execution():
+
+    async def main():
+        scheduler = JobScheduler(workers=2, max_queue=4)
+        calls = []
+        release = asyncio.Event()
+
+        async def job(value, on_stage=None, on_output=None):
+            calls.append(value)
+            on_stage("working")
+            on_output(f"{value}-part")
+            await release.wait()
+            return value * 2
+
+        first = scheduler.submit("key", job, 1)
+        second = scheduler.submit("key", job, 1)
+        other = scheduler.submit("other", job, 5)
+        assert first is second
+        assert first.waiters == 2
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(scheduler.wait(first),
+                                       scheduler.wait(second),
+                                       scheduler.wait(other))
+        assert results == [2, 2, 10]
+        assert sorted(calls) == [1, 5]
+        assert first.outputs == ["1-part"]
+        assert first.status == "done"
+        assert scheduler.stats()["deduplicated"] == 1
+        # A finished key runs again
+        assert scheduler.submit("key", job, 1) is not first
+
+    run(main())
+
+
+def test_full_queue_rejects_new_jobs():
+
+    async def main():
+        scheduler = JobScheduler(workers=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def job(on_stage=None, on_output=None):
+            await release.wait()
+
+        running = scheduler.submit("running", job)
+        await asyncio.sleep(0)
+        assert running.status == "running"
+        queued = scheduler.submit("queued", job)
+        assert scheduler.position(queued) == 0
+        with pytest.raises(QueueFullError):
+            scheduler.submit("rejected", job)
+        # Attaching to a job that is already queued never needs a slot
+        assert scheduler.submit("queued", job) is queued
+        release.set()
+        await asyncio.gather(scheduler.wait(running), scheduler.wait(queued))
+        assert scheduler.queue_depth() == 0
+
+    run(main())
+
+
+def test_failure_reaches_every_waiter():
+
+    async def main():
+        scheduler = JobScheduler(workers=1)
+
+        async def job(on_stage=None, on_output=None):
+            raise ValueError("broken PDF")
+
+        first = scheduler.submit("key", job)
+        second = scheduler.submit("key", job)
+        for job_ in (first, second):
+            with pytest.raises(ValueError, match="broken PDF"):
+                await scheduler.wait(job_)
+        assert scheduler.stats()["failed"] == 1
+
+    run(main())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_job():
+
+    async def main():
+        scheduler = JobScheduler(workers=1)
+        release = asyncio.Event()
+
+        async def job(on_stage=None, on_output=None):
+            await release.wait()
+            return "episode"
+
+        shared = scheduler.submit("key", job)
+        scheduler.submit("key", job)
+        waiter = asyncio.ensure_future(scheduler.wait(shared))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        release.set()
+        assert await scheduler.wait(shared) == "episode"
+
+    run(main())
@@ -0,0 +1,106 @@
+import random
+import numpy as np
+import pytest
+from pydub import AudioSegment
+from timeline import TimelineRenderer, recorded_body, render_timeline
+
+
+def make_clip(rng: random.Random, min_ms: int = 5, max_ms: int = 2500,
+              frame_rate: int = 44100, channels: int = 1) -> AudioSegment:
+    duration_ms = rng.randint(min_ms, max_ms) + rng.random()
+    frames = int(frame_rate * duration_ms / 1000)
+    samples = np.random.default_rng(rng.randint(0, 2**32)).integers(
+        -30000, 30000, size=frames * channels, dtype=np.int16)
+    return AudioSegment(data=samples.tobytes(),
+                        sample_width=2,
+                        frame_rate=frame_rate,
+                        channels=channels)
+
+
+def make_turns(count: int, seed: int, **kwargs):
+    rng = random.Random(seed)
+    return [(make_clip(rng, **kwargs),
+             [make_clip(rng, **kwargs) for _ in range(rng.choice([0, 1, 2]))])
+            for _ in range(count)]
+
+
+def legacy_join(turns) -> AudioSegment:
+    """The append/overlay loop ``render_timeline`` replaced."""
+    output_audio = AudioSegment.silent(duration=0)
+    for clip, overlaps in turns:
+        for overlap_clip in overlaps:
+            overlap_start_time = max(0, len(clip) - 850)
+            clip = clip.overlay(overlap_clip, position=overlap_start_time)
+            if len(overlap_clip) > 850:
+                remaining_overlap = overlap_clip[850:]
+                clip = clip.append(remaining_overlap, crossfade=0)
+        if len(clip) < 10 or len(output_audio) < 10:
+            crossfade_duration = 0
+        else:
+            crossfade_duration = min(10, len(clip) // 2,
+                                     len(output_audio) // 2)
+        output_audio = output_audio.append(clip, crossfade=crossfade_duration)
+    return output_audio
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_matches_legacy_join(seed):
+    turns = make_turns(12, seed)
+    assert render_timeline(turns).raw_data == legacy_join(turns).raw_data
+
+
+def test_matches_legacy_join_in_stereo_at_low_rate():
+    turns = make_turns(6, 7, frame_rate=16000, channels=2)
+    assert render_timeline(turns).raw_data == legacy_join(turns).raw_data
+
+
+def test_clips_shorter_than_a_crossfade():
+    turns = make_turns(10, 11, min_ms=1, max_ms=30)
+    assert render_timeline(turns).raw_data == legacy_join(turns).raw_data
+
+
+def test_empty_episode():
+    assert len(render_timeline([])) == 0
+
+
+def test_restored_renderer_carries_on_identically():
+    turns = make_turns(8, 3)
+    renderer = TimelineRenderer()
+    chunks = [renderer.add(*turn) for turn in turns[:4]]
+    renderer = TimelineRenderer.restore(renderer.state())
+    chunks += [renderer.add(*turn) for turn in turns[4:]]
+    chunks.append(renderer.finish())
+    data = b"".join(chunk.raw_data for chunk in chunks)
+    assert data == render_timeline(turns).raw_data
+
+
+def render_with_records(turns):
+    renderer = TimelineRenderer()
+    data, records = b"", []
+    for turn in turns:
+        data += renderer.add(*turn).raw_data
+        records.append({**renderer.last_turn, "state": renderer.state()})
+    return data + renderer.finish().raw_data, records
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_spliced_turns_match_a_full_render(seed):
+    rng = random.Random(seed)
+    turns = make_turns(10, seed)
+    old, records = render_with_records(turns)
+
+    def read(start, stop):
+        return old[start * 2:stop * 2]
+
+    # Replace the first turn so every later one lands somewhere else
+    edited = [(make_clip(rng), [])] + turns[1:]
+    renderer = TimelineRenderer()
+    chunks = [renderer.add(*edited[0])]
+    for index in range(1, len(edited)):
+        body = recorded_body(records[index],
+                             records[index - 1]["state"]["length"],
+                             records[index]["state"], read)
+        chunks.append(renderer.splice(records[index], body))
+    chunks.append(renderer.finish())
+    data = b"".join(chunk.raw_data for chunk in chunks)
+    assert data == render_timeline(edited).raw_data
@@ -0,0 +1,410 @@
+import math
+import base64
+import hashlib
+import numpy as np
+from pydub import AudioSegment
+from pydub.utils import db_to_float
+from typing import List, Dict, Any, Tuple, Optional, Callable
+
+OVERLAP_MS = 850
+MAX_CROSSFADE_MS = 10
+
+_SAMPLE_TYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+# A turn is the main clip followed by the clips that overlap it.
+Turn = Tuple[AudioSegment, List[AudioSegment]]
+
+
+def _len_ms(frames: int, frame_rate: int) -> int:
+    # AudioSegment.__len__
+    return round(1000 * (float(frames) / frame_rate))
+
+
+def _frame_at(ms: float, frame_rate: int) -> int:
+    # AudioSegment._parse_position
+    return int(ms * (frame_rate / 1000.0))
+
+
+def _slice_bounds(frames: int,
+                  frame_rate: int,
+                  start: Optional[int] = None,
+                  end: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Frame bounds read by pydub's ``segment[start:end]`` (milliseconds).
+    The stop bound may run past ``frames``; pydub pads that with silence.
+    """
+    length = _len_ms(frames, frame_rate)
+    start = min(start, length) if start is not None else 0
+    end = min(end, length) if end is not None else length
+    if start < 0:
+        start = length - abs(start)
+    if end < 0:
+        end = length - abs(end)
+    start = _frame_at(start, frame_rate)
+    end = _frame_at(end, frame_rate)
+    return start, max(start, end)
+
+
+def phase_period(frame_rate: int) -> int:
+    """
+    Frames after which pydub's millisecond grid repeats. Shifting a
+    timeline by a multiple of this leaves every rounding decision alone.
+    """
+    period = frame_rate // math.gcd(frame_rate, 1000)
+    # An even number of milliseconds, so round() ties still go the same way
+    if (period * 1000 // frame_rate) % 2:
+        period *= 2
+    return period
+
+
+def _fade_gains(frames: int, frame_rate: int, from_gain: float,
+                to_gain: float) -> np.ndarray:
+    """Per-frame gains of ``AudioSegment.fade(start=0, end=inf)`` for fades up to 100 ms."""
+    fade_frames = _len_ms(frames, frame_rate) * (frame_rate / 1000.0)
+    from_power = db_to_float(from_gain)
+    scale_step = (db_to_float(to_gain) - from_power) / fade_frames
+    count = min(int(fade_frames), frames)
+    return np.array([from_power + (scale_step * i) for i in range(count)])
+
+
+def sync_turns(turns: List[Turn]) -> List[Turn]:
+    """
+    Convert every clip to one common format, the way ``AudioSegment._sync``
+    would while appending onto ``AudioSegment.silent(duration=0)``.
+    """
+    clips = [AudioSegment.silent(duration=0)]
+    for clip, overlaps in turns:
+        clips.append(clip)
+        clips.extend(overlaps)
+    channels = max(clip.channels for clip in clips)
+    frame_rate = max(clip.frame_rate for clip in clips)
+    sample_width = max(clip.sample_width for clip in clips)
+
+    def sync(clip):
+        return clip.set_channels(channels).set_frame_rate(
+            frame_rate).set_sample_width(sample_width)
+
+    return [(sync(clip), [sync(overlap) for overlap in overlaps])
+            for clip, overlaps in turns]
+
+
+def _plan_turn(clip_frames: int, overlap_frames: List[int], length: int,
+               frame_rate: int) -> Dict[str, Any]:
+    """Place one turn after ``length`` frames of episode; see ``plan_timeline``."""
+    # Build the turn: [("add", source, src_start, src_stop, dst) | ("resize", frames)]
+    ops = [("add", 0, 0, clip_frames, 0)]
+    turn_length = clip_frames
+    turn_span = clip_frames
+    for ix, frames in enumerate(overlap_frames, start=1):
+        position = max(0, _len_ms(turn_length, frame_rate) - OVERLAP_MS)
+        start, stop = _slice_bounds(turn_length, frame_rate, position)
+        ops.append(("resize", stop))
+        ops.append(("add", ix, 0, min(frames, stop - start), start))
+        turn_length = stop
+        if _len_ms(frames, frame_rate) > OVERLAP_MS:
+            src_start, src_stop = _slice_bounds(frames, frame_rate,
+                                                OVERLAP_MS)
+            ops.append(("add", ix, src_start, src_stop, turn_length))
+            turn_length += src_stop - src_start
+        turn_span = max(turn_span, turn_length)
+
+    turn_ms = _len_ms(turn_length, frame_rate)
+    master_ms = _len_ms(length, frame_rate)
+    if turn_ms < 10 or master_ms < 10:
+        crossfade = 0
+    else:
+        crossfade = min(MAX_CROSSFADE_MS, turn_ms // 2, master_ms // 2)
+
+    turn = {
+        "ops": ops,
+        "length": turn_length,
+        "crossfade": crossfade,
+    }
+    if not crossfade:
+        turn.update(cut=length,
+                    fade_out=0,
+                    fade_in=0,
+                    xfade=0,
+                    body=(0, turn_length))
+    else:
+        cut, tail_stop = _slice_bounds(length, frame_rate, -crossfade)
+        _, head_stop = _slice_bounds(turn_length, frame_rate, 0, crossfade)
+        fade_out = len(_fade_gains(tail_stop - cut, frame_rate, 0, -120))
+        fade_in = len(_fade_gains(head_stop, frame_rate, -120, 0))
+        _, xfade = _slice_bounds(fade_out, frame_rate)
+        turn.update(cut=cut,
+                    fade_out=fade_out,
+                    fade_in=fade_in,
+                    xfade=xfade,
+                    body=_slice_bounds(turn_length, frame_rate, crossfade))
+        turn_span = max(turn_span, head_stop)
+    body_start, body_stop = turn["body"]
+    turn["span"] = max(turn_span, body_stop)
+    turn["offset"] = turn["cut"] + turn["xfade"]
+    turn["end"] = turn["offset"] + body_stop - body_start
+    return turn
+
+
+def plan_timeline(turn_frames: List[Tuple[int, List[int]]],
+                  frame_rate: int) -> Dict[str, Any]:
+    """
+    Lay out the episode from clip lengths alone.
+
+    ``turn_frames`` holds ``(clip_frames, [overlap_frames, ...])`` per turn.
+    Overlaps start 850 ms before the end of the clip they interrupt and the
+    part that runs past it extends the turn. Turns are joined with a
+    crossfade of up to 10 ms. Offsets reproduce the ``overlay``/``append``
+    chain of pydub frame for frame, including its millisecond rounding.
+    """
+    turns = []
+    length = 0
+    span = 0
+    for clip_frames, overlap_frames in turn_frames:
+        turn = _plan_turn(clip_frames, overlap_frames, length, frame_rate)
+        length = turn["end"]
+        span = max(span, length, turn["cut"] + turn["fade_out"])
+        turns.append(turn)
+    return {"turns": turns, "length": length, "span": span}
+
+
+def _encode(samples: np.ndarray, sample_width: int) -> str:
+    data = samples.astype(_SAMPLE_TYPES[sample_width]).tobytes()
+    return base64.b64encode(data).decode("ascii")
+
+
+def _decode(data: str, channels: int, sample_width: int) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data),
+                         dtype=_SAMPLE_TYPES[sample_width]).reshape(
+                             -1, channels)
+
+
+def _samples(clip: AudioSegment) -> np.ndarray:
+    dtype = _SAMPLE_TYPES[clip.sample_width]
+    return np.frombuffer(clip.raw_data, dtype=dtype).reshape(-1, clip.channels)
+
+
+class TimelineRenderer:
+    """
+    Mixes turns one at a time and hands back audio as soon as no later turn
+    can change it.
+
+    Later turns only reach back into the episode for their crossfade, so
+    everything before the last ``MAX_CROSSFADE_MS`` is final. Only that tail
+    and the turn being mixed stay in memory. Clips are converted to the
+    format of the first turn; ``render_timeline`` gives the same output when
+    every clip shares that format.
+    """
+
+    def __init__(self):
+        self.format = None
+        self.length = 0
+        # Frames of the episode from ``base`` onwards that are not final yet
+        self.base = 0
+        self.pending = None
+        # Clip lengths and head of the last turn added, see ``splice``
+        self.last_turn = None
+
+    def _sync(self, clip: AudioSegment) -> AudioSegment:
+        channels, frame_rate, sample_width = self.format
+        return clip.set_channels(channels).set_frame_rate(
+            frame_rate).set_sample_width(sample_width)
+
+    def _audio(self, data: np.ndarray) -> AudioSegment:
+        channels, frame_rate, sample_width = self.format
+        return AudioSegment(data=data.astype(
+            _SAMPLE_TYPES[sample_width]).tobytes(),
+                            sample_width=sample_width,
+                            frame_rate=frame_rate,
+                            channels=channels)
+
+    def add(self, clip: AudioSegment,
+            overlaps: List[AudioSegment]) -> AudioSegment:
+        """Mix the next turn and return the audio it made final."""
+        if self.format is None:
+            first, _ = sync_turns([(clip, overlaps)])[0]
+            self.format = (first.channels, first.frame_rate,
+                           first.sample_width)
+            self.pending = np.zeros((0, first.channels), dtype=np.int64)
+        channels, frame_rate, sample_width = self.format
+        info = np.iinfo(_SAMPLE_TYPES[sample_width])
+        low, high = info.min, info.max
+
+        source = [_samples(self._sync(c)) for c in [clip] + list(overlaps)]
+        frames = [len(samples) for samples in source]
+        turn = _plan_turn(frames[0], frames[1:], self.length, frame_rate)
+
+        local = np.zeros((turn["span"], channels), dtype=np.int64)
+        for op in turn["ops"]:
+            if op[0] == "resize":
+                local[op[1]:] = 0
+                continue
+            _, ix, src_start, src_stop, dst = op
+            piece = source[ix][src_start:src_stop]
+            end = dst + len(piece)
+            local[dst:end] += piece
+            np.clip(local[dst:end], low, high, out=local[dst:end])
+
+        head = local[:turn["fade_in"]]
+        self.last_turn = {
+            "frames": frames,
+            "head": _encode(head, sample_width),
+        }
+        body_start, body_stop = turn["body"]
+        return self._place(turn, head, local[body_start:body_stop])
+
+    def splice(self, record: Dict[str, Any],
+               body: np.ndarray) -> Optional[AudioSegment]:
+        """
+        Add a turn mixed by an earlier render without its clips. ``record``
+        is the renderer's ``last_turn`` after mixing it then, and ``body``
+        the audio it placed after its crossfade (see ``recorded_body``).
+        Only the crossfade into it is mixed again, so the result matches
+        ``add`` wherever the turn lands. Returns None if the turn would be
+        laid out differently here, and has to be mixed with ``add``.
+        """
+        channels, frame_rate, sample_width = self.format
+        frames = record["frames"]
+        turn = _plan_turn(frames[0], frames[1:], self.length, frame_rate)
+        head = _decode(record["head"], channels, sample_width)
+        body_start, body_stop = turn["body"]
+        if len(head) != turn["fade_in"] or len(body) != body_stop - body_start:
+            return None
+        self.last_turn = {"frames": frames, "head": record["head"]}
+        return self._place(turn, head, body.astype(np.int64))
+
+    def _place(self, turn: Dict[str, Any], head: np.ndarray,
+               body: np.ndarray) -> AudioSegment:
+        """Crossfade into the mixed turn, append its body and pop final audio."""
+        channels, frame_rate, sample_width = self.format
+        info = np.iinfo(_SAMPLE_TYPES[sample_width])
+        low, high = info.min, info.max
+        span = max(turn["end"], turn["cut"] + turn["fade_out"]) - self.base
+        if span > len(self.pending):
+            grown = np.zeros((span, channels), dtype=np.int64)
+            grown[:len(self.pending)] = self.pending
+            self.pending = grown
+        output = self.pending
+
+        cut = turn["cut"] - self.base
+        if turn["crossfade"]:
+            gains = _fade_gains(turn["fade_out"], frame_rate, 0, -120)
+            tail = np.floor(output[cut:cut + len(gains)] * gains[:, None])
+            head = np.floor(head * _fade_gains(turn["fade_in"], frame_rate,
+                                               -120, 0)[:, None])
+            xfade = np.zeros((turn["xfade"], channels), dtype=np.int64)
+            size = min(len(tail), len(xfade))
+            xfade[:size] = np.clip(tail[:size], low, high)
+            size = min(len(head), len(xfade))
+            xfade[:size] += np.clip(head[:size], low, high).astype(np.int64)
+            np.clip(xfade, low, high, out=xfade)
+            output[cut:cut + len(xfade)] = xfade
+
+        offset = turn["offset"] - self.base
+        end = turn["end"] - self.base
+        output[offset:end] = body
+        output[end:] = 0
+        self.length = turn["end"]
+
+        # The next turn's crossfade starts no earlier than this
+        ready, _ = _slice_bounds(self.length, frame_rate, -MAX_CROSSFADE_MS)
+        return self._pop(max(self.base, ready))
+
+    def _pop(self, stop: int) -> AudioSegment:
+        count = stop - self.base
+        data = self.pending[:count]
+        self.pending = self.pending[count:].copy()
+        self.base = stop
+        return self._audio(data)
+
+    def state(self) -> Dict[str, Any]:
+        """Everything needed to carry on mixing later, see ``restore``."""
+        _, _, sample_width = self.format
+        return {
+            "format": list(self.format),
+            "length": self.length,
+            "base": self.base,
+            "pending": _encode(self.pending[:self.length - self.base],
+                               sample_width),
+        }
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any]) -> "TimelineRenderer":
+        renderer = cls()
+        renderer.format = tuple(state["format"])
+        channels, _, sample_width = renderer.format
+        renderer.length = state["length"]
+        renderer.base = state["base"]
+        renderer.pending = _decode(state["pending"], channels,
+                                   sample_width).astype(np.int64)
+        return renderer
+
+    def finish(self) -> AudioSegment:
+        """The rest of the episode, once every turn has been added."""
+        if self.format is None:
+            return AudioSegment.silent(duration=0)
+        return self._pop(self.length)
+
+
+def recorded_body(record: Dict[str, Any], previous_length: int,
+                  state: Dict[str, Any],
+                  read: Callable[[int, int], bytes]) -> Optional[np.ndarray]:
+    """
+    The body of a turn in an earlier render, for ``TimelineRenderer.splice``.
+    ``record`` is the turn's ``last_turn``, ``state`` the renderer's state
+    right after it and ``previous_length`` the episode's length before it.
+    ``read(start, stop)`` returns raw frames of that render's output; the body's
+    frames that were not final yet come from ``state``. None if the record
+    does not describe the turn that ends at ``state``.
+    """
+    channels, frame_rate, sample_width = state["format"]
+    frames = record["frames"]
+    turn = _plan_turn(frames[0], frames[1:], previous_length, frame_rate)
+    offset, end, base = turn["offset"], turn["end"], state["base"]
+    if end != state["length"]:
+        return None
+    pending = _decode(state["pending"], channels, sample_width)
+    parts = [pending[max(0, offset - base):end - base]]
+    if offset < base:
+        parts.insert(
+            0,
+            np.frombuffer(read(offset, base),
+                          dtype=_SAMPLE_TYPES[sample_width]).reshape(
+                              -1, channels))
+    body = np.concatenate(parts)
+    return body if len(body) == end - offset else None
+
+
+def state_key(state: Dict[str, Any]) -> str:
+    """
+    Identifies what a renderer in ``state`` will do with the turns still to
+    come. Renderers with equal keys produce the same audio from then on,
+    even when one is further into the episode than the other.
+    """
+    _, frame_rate, _ = state["format"]
+    length = state["length"]
+    settled = _len_ms(length, frame_rate) >= 2 * MAX_CROSSFADE_MS
+    return hashlib.sha256(
+        f"{state['format']}|{length % phase_period(frame_rate)}|"
+        f"{length - state['base']}|{settled}|{state['pending']}".encode(
+            "ascii")).hexdigest()
+
+
+def render_timeline(turns: List[Turn]) -> AudioSegment:
+    """
+    Mix decoded turns into a single episode.
+
+    Produces the same audio as appending the turns one after another with
+    ``AudioSegment.overlay``/``append``, in time linear in the episode length.
+    Clips are converted to a common format up front, so the output matches
+    sample for sample when they already share one (as TTS clips do) at
+    11025 Hz or above.
+    """
+    if not turns:
+        return AudioSegment.silent(duration=0)
+    renderer = TimelineRenderer()
+    chunks = [renderer.add(clip, overlaps) for clip, overlaps in sync_turns(turns)]
+    chunks.append(renderer.finish())
+    return AudioSegment(data=b"".join(chunk.raw_data for chunk in chunks),
+                        sample_width=chunks[0].sample_width,
+                        frame_rate=chunks[0].frame_rate,
+                        channels=chunks[0].channels)
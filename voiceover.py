@@ -1,18 +1,174 @@
 import os
+import re
+import math
+import time
+import functools
 from dotenv import load_dotenv
 import hashlib
-import queue
-from typing import List, Dict, Any
-from pydub import AudioSegment
-from tqdm.auto import tqdm
+from typing import List, Dict, Set, Any, Optional, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Tuple, TYPE_CHECKING
 import httpx
 import backoff
+import wave
+import difflib
 import asyncio
+import metrics
+from uuid import uuid4
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrency import AdaptiveLimiter, parse_retry_after
+from clip_store import ClipStore, clip_key, default_clip_store, link_or_copy
+from decoder import DECODE_WORKERS, ffmpeg_available
+
+# Rendering needs numpy and pydub; they are imported when first used
+if TYPE_CHECKING:
+    from pydub import AudioSegment
+    from timeline import Turn, TimelineRenderer
 
 load_dotenv()
 
 ELEVEN_LABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
-ELEVEN_LABS_API_URL = "https://api.elevenlabs.io/v1/text-to-speech"
+ELEVEN_LABS_API_URL = os.getenv(
+    "ELEVENLABS_API_URL", "https://api.elevenlabs.io/v1/text-to-speech")
+TTS_MODEL = os.getenv("TTS_MODEL", "eleven_monolingual_v1")
+TTS_MIN_CONCURRENCY = int(os.getenv("TTS_MIN_CONCURRENCY", 1))
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", 8))
+# Decode clips to WAV on a worker pool once downloaded (needs ffmpeg; on by
+# default when it is installed, see `tts_decode`)...
+TTS_DECODE = os.getenv("TTS_DECODE")
+# ...or while they download (defaults to TTS_DECODE)
+TTS_STREAM_DECODE = os.getenv("TTS_STREAM_DECODE")
+# Split long turns at sentence boundaries and synthesize the pieces in
+# parallel (needs ffmpeg to stitch them)
+TTS_SPLIT = os.getenv("TTS_SPLIT", "0") == "1"
+# Turns longer than this are split, until enough requests have been timed to
+# derive the length from their latency per character
+TTS_SPLIT_CHARS = int(os.getenv("TTS_SPLIT_CHARS", 300))
+TTS_SPLIT_MIN_CHARS = int(os.getenv("TTS_SPLIT_MIN_CHARS", 100))
+TTS_SPLIT_MIN_SAMPLES = int(os.getenv("TTS_SPLIT_MIN_SAMPLES", 20))
+# Silence kept on each side of a junction between stitched pieces
+SPLIT_PAUSE_MS = 120
+SPLIT_CROSSFADE_MS = 10
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+@functools.lru_cache(maxsize=None)
+def tts_decode() -> bool:
+    """
+    Whether to decode clips once downloaded. Probing for ffmpeg loads
+    pydub, so it is done on the first clip rather than on import.
+    """
+    if TTS_DECODE is not None:
+        return TTS_DECODE == "1"
+    return ffmpeg_available()
+
+
+def tts_stream_decode() -> bool:
+    """Whether to decode clips while they download."""
+    if TTS_STREAM_DECODE is not None:
+        return TTS_STREAM_DECODE == "1"
+    return tts_decode()
+
+
+class CharLatency:
+    """
+    Rolling least-squares fit of TTS latency against the length of the text
+    of the last `window` requests: seconds = overhead + per_char * chars.
+    """
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, chars: int, seconds: float):
+        self.samples.append((chars, seconds))
+
+    def fit(self) -> Optional[Tuple[float, float]]:
+        """(overhead, per_char) in seconds, or None without enough spread."""
+        count = len(self.samples)
+        if count < 2:
+            return None
+        mean_chars = sum(chars for chars, _ in self.samples) / count
+        mean_seconds = sum(seconds for _, seconds in self.samples) / count
+        variance = sum((chars - mean_chars)**2 for chars, _ in self.samples)
+        if variance == 0:
+            return None
+        per_char = sum((chars - mean_chars) * (seconds - mean_seconds)
+                       for chars, seconds in self.samples) / variance
+        return mean_seconds - per_char * mean_chars, per_char
+
+    def split_chars(self,
+                    default: int = TTS_SPLIT_CHARS,
+                    min_chars: int = TTS_SPLIT_MIN_CHARS,
+                    min_samples: int = TTS_SPLIT_MIN_SAMPLES,
+                    step: int = 50) -> Optional[int]:
+        """
+        Length above which a turn is worth splitting: where synthesizing its
+        characters takes longer than a request's fixed overhead. None if
+        latency does not grow with length, so splitting would not help.
+        Rounded to `step`, so split points and their cached pieces stay
+        stable from run to run.
+        """
+        fit = self.fit() if len(self) >= min_samples else None
+        if fit is None:
+            return default
+        overhead, per_char = fit
+        if per_char <= 0:
+            return None
+        return max(min_chars, round(max(overhead, 0) / per_char / step) * step)
+
+
+tts_latency = CharLatency()
+
+
+def split_sentences(text: str, max_chars: int) -> List[str]:
+    """
+    `text` cut at sentence boundaries into as few pieces of about equal
+    length as keep each under `max_chars`, where sentences allow.
+    """
+    sentences = SENTENCE_END.split(text.strip())
+    target = len(text) / math.ceil(len(text) / max_chars)
+    pieces, piece = [], ""
+    for sentence in sentences:
+        piece = f"{piece} {sentence}" if piece else sentence
+        if len(piece) >= target:
+            pieces.append(piece)
+            piece = ""
+    if piece and pieces and len(piece) < target / 2:
+        # Too short to be worth a request of its own
+        pieces[-1] = f"{pieces[-1]} {piece}"
+    elif piece:
+        pieces.append(piece)
+    return pieces
+
+
+def stitch_clips(paths: List[str], filename: str):
+    """
+    Join the clips at `paths` into a WAV at `filename`. The silence around
+    each junction is trimmed to a sentence pause and the pieces are
+    crossfaded, so the seams are not heard.
+    """
+    from pydub import AudioSegment
+    from pydub.silence import detect_leading_silence
+    audio = AudioSegment.from_file(paths[0])
+    for path in paths[1:]:
+        clip = AudioSegment.from_file(path)
+        tail = detect_leading_silence(audio[-1000:].reverse())
+        audio = audio[:len(audio) - max(0, tail - SPLIT_PAUSE_MS)]
+        head = detect_leading_silence(clip)
+        clip = clip[max(0, head - SPLIT_PAUSE_MS):]
+        audio = audio.append(clip,
+                             crossfade=min(SPLIT_CROSSFADE_MS, len(audio),
+                                           len(clip)))
+    tmp = f"{filename}.{uuid4().hex}.tmp"
+    try:
+        audio.export(tmp, format="wav")
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
 
 def get_clip_filename(speaker: str, text: str, output_dir: str):
@@ -20,129 +176,738 @@ def get_clip_filename(speaker: str, text: str, output_dir: str):
     return os.path.join(output_dir, f"{speaker}_{text_hash}.wav")
 
 
-async def generate_voice_clips(dialogue: List[Dict[str, Any]],
-                               output_dir: str = "audio_clips"):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
-    dialogue_queue = queue.Queue()
-    for line in dialogue:
-        dialogue_queue.put(line)
-        if "overlaps" in line:
-            for overlap in line.get("overlaps"):
-                dialogue_queue.put(overlap)
-
-    @backoff.on_exception(backoff.expo,
-                          httpx.HTTPStatusError,
-                          max_tries=5,
-                          giveup=lambda e: e.response.status_code != 429)
-    async def generate_audio(line, previous_text=None):
-        speaker = line.get("speaker")
-        text = line.get("text")
-        speaker_voice_id = line.get("speaker_voice_id")
-        filename = get_clip_filename(speaker, text, output_dir)
-        if os.path.exists(filename):
-            return
 
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": ELEVEN_LABS_API_KEY
-        }
-        data = {
-            "text": text,
-            "model_id": "eleven_monolingual_v1",
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.5,
-            },
-            "output_format": "mp3_44100_128",
-            "enable_logging": False,
-            "previous_text": previous_text,
-            "seed": 42
-        }
+def _should_retry(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUS_CODES
+    return True
+
+
+def tts_client(max_connections: int = TTS_MAX_CONCURRENCY,
+               **kwargs) -> httpx.AsyncClient:
+    """
+    One keep-alive client shared by every clip in a run, over HTTP/2 when the
+    `h2` package is installed.
+    """
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_connections)
+    try:
+        return httpx.AsyncClient(timeout=600,
+                                 limits=limits,
+                                 http2=True,
+                                 **kwargs)
+    except ImportError:
+        return httpx.AsyncClient(timeout=600, limits=limits, **kwargs)
+
+
+@backoff.on_exception(backoff.expo,
+                      (httpx.HTTPStatusError, httpx.TransportError),
+                      max_tries=5,
+                      giveup=lambda e: not _should_retry(e),
+                      on_backoff=lambda _: metrics.current_span().add("retries"))
+async def _request_audio(client: httpx.AsyncClient,
+                         limiter: AdaptiveLimiter,
+                         speaker_voice_id: str,
+                         data: Dict[str, Any],
+                         store: ClipStore,
+                         key: str,
+                         decode: Optional[bool] = None) -> str:
+    """
+    Stream the clip into `store` under `key` and return its path. The body
+    is written to disk as it arrives rather than buffered in memory.
+    """
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": ELEVEN_LABS_API_KEY
+    }
+    span = metrics.current_span()
+    async with limiter:
+        started = time.perf_counter()
         try:
-            async with httpx.AsyncClient(timeout=600) as client:
-                response = await client.post(
+            async with client.stream(
+                    "POST",
                     f"{ELEVEN_LABS_API_URL}/{speaker_voice_id}",
                     headers=headers,
-                    json=data)
-                response.raise_for_status()
-                with open(filename, "wb") as f:
-                    f.write(response.content)
-        except httpx.HTTPStatusError as e:
+                    json=data) as response:
+                retry_after = parse_retry_after(
+                    response.headers.get("retry-after"))
+                limiter.record(response.status_code not in RETRY_STATUS_CODES,
+                               retry_after)
+                if response.status_code >= 400:
+                    await response.aread()
+                    response.raise_for_status()
+
+                async def chunks():
+                    async for chunk in response.aiter_bytes():
+                        span.add("bytes", len(chunk))
+                        yield chunk
+
+                if decode is None:
+                    decode = tts_stream_decode()
+                path = await store.put_stream(key, chunks(), decode=decode)
+                tts_latency.add(len(data["text"]),
+                                time.perf_counter() - started)
+                return path
+        except httpx.TransportError:
+            limiter.record(False)
+            raise
+
+
+def _tts_request(line: Dict[str, Any],
+                 previous_text: Optional[str],
+                 next_text: Optional[str] = None
+                 ) -> Tuple[str, Dict[str, Any]]:
+    """The voice and request body that synthesize `line`."""
+    data = {
+        "text": line.get("text"),
+        "model_id": TTS_MODEL,
+        "voice_settings": {
+            "stability": 0.5,
+            "similarity_boost": 0.5,
+        },
+        "output_format": "mp3_44100_128",
+        "enable_logging": False,
+        "previous_text": previous_text,
+        "seed": 42
+    }
+    if next_text is not None:
+        data["next_text"] = next_text
+    return line.get("speaker_voice_id"), data
+
+
+def _turn_key(turn: Dict[str, Any],
+              previous_text: Optional[str]) -> Tuple[str, Optional[str]]:
+    """Key of `turn` (see `turn_keys`) and the previous_text of the next."""
+    keys = []
+    for line in [turn] + list(turn.get("overlaps") or []):
+        keys.append(clip_key(*_tts_request(line, previous_text)))
+        previous_text = line.get("text")
+    digest = hashlib.sha256("|".join(keys).encode("ascii")).hexdigest()
+    return digest, previous_text
+
+
+def turn_keys(dialogue: List[Dict[str, Any]]) -> List[str]:
+    """
+    A key per turn that changes whenever any of its clips would: the TTS
+    request of its line and overlaps, including the previous_text context
+    taken from the line before.
+    """
+    keys = []
+    previous_text = None
+    for turn in dialogue:
+        key, previous_text = _turn_key(turn, previous_text)
+        keys.append(key)
+    return keys
+
+
+async def _fetch_clip(speaker_voice_id: str, data: Dict[str, Any],
+                      client: Optional[httpx.AsyncClient],
+                      limiter: AdaptiveLimiter, store: ClipStore,
+                      span) -> str:
+    """
+    Path of the clip for a TTS request, from the store or synthesized into
+    it. Prefers the decoded WAV so assembly can skip ffmpeg; clips that were
+    not decoded while downloading are decoded now, in parallel with the rest
+    of the synthesis.
+    """
+    key = clip_key(speaker_voice_id, data)
+    cached = store.get(key)
+    if cached is not None:
+        span.add("cache_hits")
+    else:
+        span.add("cache_misses")
+        if client is not None:
+            cached = await _request_audio(client, limiter, speaker_voice_id,
+                                          data, store, key)
+        else:
+            async with tts_client(1) as client:
+                cached = await _request_audio(client, limiter,
+                                              speaker_voice_id, data, store,
+                                              key)
+    decoded = store.decoded_path(key)
+    if not os.path.exists(decoded):
+        decoded = None
+        if tts_decode():
+            with metrics.span("tts.decode"):
+                decoded = await store.decode(key)
+    return decoded or cached
+
+
+async def _generate_split(line: Dict[str, Any], pieces: List[str],
+                          filename: str, previous_text: Optional[str],
+                          client: Optional[httpx.AsyncClient],
+                          limiter: AdaptiveLimiter, store: ClipStore,
+                          span) -> Optional[str]:
+    """
+    Synthesize `pieces` of a line in parallel and stitch them into
+    `filename`. Each piece gets the text around it as previous_text and
+    next_text, so prosody carries across the seams. None if any piece
+    failed.
+    """
+    requests = [
+        _tts_request({
+            **line, "text": piece
+        }, " ".join(pieces[:ix]) or previous_text, " ".join(pieces[ix + 1:])
+                     or None) for ix, piece in enumerate(pieces)
+    ]
+    keys = [clip_key(voice_id, data) for voice_id, data in requests]
+    for key in keys:
+        store.acquire(key)
+    try:
+        paths = await asyncio.gather(*(_fetch_clip(
+            voice_id, data, client, limiter, store, span)
+                                       for voice_id, data in requests))
+        await asyncio.to_thread(stitch_clips, paths, filename)
+    except Exception as e:
+        print(f"Failed to synthesize {line.get('speaker')} in "
+              f"{len(pieces)} pieces, trying it whole: {e}")
+        return None
+    finally:
+        for key in keys:
+            store.release(key)
+    span.add("split_pieces", len(pieces))
+    return filename
+
+
+async def generate_audio(line: Dict[str, Any],
+                         output_dir: str,
+                         previous_text: Optional[str] = None,
+                         client: Optional[httpx.AsyncClient] = None,
+                         limiter: Optional[AdaptiveLimiter] = None,
+                         store: Optional[ClipStore] = None,
+                         split_chars: Optional[int] = None) -> Optional[str]:
+    """
+    Place the clip of `line` in `output_dir` and return its path. With
+    `split_chars`, a longer line that is not cached whole is synthesized
+    in sentence-aligned pieces (see `split_sentences`).
+    """
+    speaker = line.get("speaker")
+    text = line.get("text") or ""
+    filename = get_clip_filename(speaker, text, output_dir)
+    speaker_voice_id, data = _tts_request(line, previous_text)
+    store = store or default_clip_store()
+    limiter = limiter or AdaptiveLimiter(1, 1)
+    with metrics.span("tts.clip", speaker=speaker) as span:
+        key = clip_key(speaker_voice_id, data)
+        if split_chars and len(text) > split_chars and not os.path.exists(
+                store.path(key)):
+            pieces = split_sentences(text, split_chars)
+            if len(pieces) > 1 and await _generate_split(
+                    line, pieces, filename, previous_text, client, limiter,
+                    store, span):
+                return filename
+        # Not evicted between being fetched and being linked into the run
+        store.acquire(key)
+        try:
+            path = await _fetch_clip(speaker_voice_id, data, client, limiter,
+                                     store, span)
+            link_or_copy(path, filename)
+        except (httpx.HTTPStatusError, httpx.TransportError) as e:
+            span.set(error=str(e))
             print(f"Failed to generate audio for {speaker}: {e}")
+            return
+        finally:
+            store.release(key)
+    return filename
+
+
+async def generate_voice_clips(dialogue: List[Dict[str, Any]],
+                               output_dir: str = "audio_clips",
+                               **kwargs):
+
+    async def turns():
+        for line in dialogue:
+            yield line
+
+    await generate_voice_clips_stream(turns(), output_dir, **kwargs)
+
 
-    semaphore = asyncio.Semaphore(2)
+async def generate_voice_clips_stream(
+        dialogue_turns: AsyncIterator[Dict[str, Any]],
+        output_dir: str = "audio_clips",
+        min_concurrency: int = TTS_MIN_CONCURRENCY,
+        max_concurrency: int = TTS_MAX_CONCURRENCY,
+        limiter: Optional[AdaptiveLimiter] = None,
+        store: Optional[ClipStore] = None,
+        on_turn: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+        verified: Optional[Set[str]] = None,
+        on_clip: Optional[Callable[[str], Awaitable[None]]] = None,
+        split_long_turns: bool = TTS_SPLIT
+) -> List[Dict[str, Any]]:
+    """
+    Synthesize the clips of each turn (and its overlaps) as soon as the turn
+    arrives, so TTS overlaps with dialogue generation. Returns the turns in
+    the order they were received.
+
+    Requests share one pooled client; their parallelism adapts between
+    `min_concurrency` and `max_concurrency` unless a `limiter` is passed in.
+    Clips already in the shared clip store are reused instead of synthesized,
+    and a line repeated by the same speaker is requested only once: with
+    the context of its first occurrence, since the run directory holds one
+    clip file per speaker and text (see `get_clip_filename`).
+    `on_turn` is awaited with each turn, in dialogue order, once its clips
+    and those of every earlier turn are on disk. Clip files listed in
+    `verified` are known to be intact and are not synthesized again;
+    `on_clip` is awaited with the path of every other clip once it is written.
+    With `split_long_turns`, lines longer than `tts_latency.split_chars()`
+    are synthesized as sentence-aligned pieces in parallel and stitched,
+    while the limiter has slots that other lines are not using.
+    """
+    from tqdm.auto import tqdm
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    store = store or default_clip_store()
+    limiter = limiter or AdaptiveLimiter(min_concurrency,
+                                         max_concurrency,
+                                         initial_limit=2)
+    verified = verified or set()
+    dialogue = []
     tasks = []
+    pending = {}
+    deduplicated = 0
+    in_progress = 0
+    ready = asyncio.Queue()
+
+    async def deliver():
+        while True:
+            item = await ready.get()
+            if item is None:
+                return
+            turn, clips = item
+            await clips
+            await on_turn(turn)
+
+    def split_chars(text):
+        """
+        Length to split a line at, or None. Read per line, so it follows the
+        latency observed so far, and only long enough to give each piece a
+        request slot that other lines are not using.
+        """
+        chars = tts_latency.split_chars() if split_long_turns else None
+        slots = int(limiter.limit) - in_progress + 1
+        if chars is None or slots < 2:
+            return None
+        return max(chars, math.ceil(len(text) / slots))
+
+    async def synthesize(line, previous_text, client):
+        nonlocal in_progress
+        in_progress += 1
+        try:
+            filename = await generate_audio(line, output_dir, previous_text,
+                                            client, limiter, store,
+                                            split_chars(line.get("text")
+                                                        or ""))
+        finally:
+            in_progress -= 1
+        if filename is not None and on_clip is not None:
+            await on_clip(filename)
+
+    delivery = asyncio.create_task(deliver()) if on_turn else None
     previous_text = None
+    try:
+        async with tts_client(limiter.max_limit) as client:
+            async for turn in dialogue_turns:
+                dialogue.append(turn)
+                turn_tasks = []
+                for line in [turn] + list(turn.get("overlaps") or []):
+                    filename = get_clip_filename(line.get("speaker"),
+                                                 line.get("text"), output_dir)
+                    if filename in pending:
+                        # Same speaker, same line: one file, so one request.
+                        # Deduplicated on the file rather than `clip_key`:
+                        # a repeat in another context would overwrite the
+                        # first clip, so it reuses that clip's prosody
+                        deduplicated += 1
+                        turn_tasks.append(pending[filename])
+                    elif filename not in verified:
+                        task = asyncio.create_task(
+                            synthesize(line, previous_text, client))
+                        pending[filename] = task
+                        tasks.append(task)
+                        turn_tasks.append(task)
+                    previous_text = line.get("text")
+                if delivery is not None:
+                    # A failed clip is reported once, below; the turn is
+                    # still delivered and plays without it
+                    ready.put_nowait((turn,
+                                      asyncio.gather(*turn_tasks,
+                                                     return_exceptions=True)))
+            # One failed clip does not stop the others, so they are on disk
+            # for a resumed run
+            with tqdm(total=len(tasks)) as progress:
+                for task in tasks:
+                    task.add_done_callback(lambda _: progress.update())
+                results = await asyncio.gather(*tasks,
+                                               return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if delivery is not None:
+            ready.put_nowait(None)
+            await delivery
+    finally:
+        # Only left running if the dialogue or a turn's delivery failed
+        leftover = tasks + ([delivery] if delivery is not None else [])
+        for task in leftover:
+            task.cancel()
+        await asyncio.gather(*leftover, return_exceptions=True)
+    metrics.current_span().add("tts_deduplicated", deduplicated)
+    print(f"Clip cache: {store.hits} hits, {store.misses} misses, "
+          f"{deduplicated} duplicate lines shared a request")
+    return dialogue
 
-    while not dialogue_queue.empty():
-        line = dialogue_queue.get()
-        await semaphore.acquire()
-        task = asyncio.create_task(generate_audio(line, previous_text))
-        task.add_done_callback(lambda _: semaphore.release())
-        tasks.append(task)
-        previous_text = line.get("text")
-    for task in tqdm.as_completed(tasks):
-        await task
 
+def load_turn(line: Dict[str, Any], output_dir: str) -> Optional["Turn"]:
+    """Decode the clip of a turn and its overlaps, or None if it is missing."""
+    from pydub import AudioSegment
+    filename = get_clip_filename(line.get("speaker"), line.get("text"),
+                                 output_dir)
+    try:
+        clip = AudioSegment.from_file(file=filename)
+    except FileNotFoundError:
+        print(f"Audio clip not found: {filename}")
+        return None
 
-def join_audio_clips(dialogue: List[Dict[str, Any]],
-                     output_dir: str = "audio_clips",
-                     output_file: str = "final_output_1.wav"):
-    output_audio = AudioSegment.silent(duration=0)
-
-    for ix, line in enumerate(
-            tqdm(dialogue, desc="Joining audio clips", leave=False)):
-        speaker = line.get("speaker")
-        text = line.get("text")
-        filename = get_clip_filename(speaker, text, output_dir)
+    overlaps = []
+    for overlap in line.get("overlaps") or []:
+        overlap_filename = get_clip_filename(overlap.get("speaker"),
+                                             overlap.get("text"), output_dir)
         try:
-            clip = AudioSegment.from_file(file=filename)
+            overlaps.append(AudioSegment.from_file(file=overlap_filename))
         except FileNotFoundError:
-            print(f"Audio clip not found: {filename}")
-            continue
-
-        # print(f"Length of clip before adding crossfade: {len(clip)} ms")
-        # print(
-        #     f"Length of output_audio before adding clip: {len(output_audio)} ms"
-        # )
-
-        # print(f"Length of clip before adding crossfade: {len(clip)} ms")
-        # print(
-        #     f"Length of output_audio before adding clip: {len(output_audio)} ms"
-        # )
-
-        if "overlaps" in line:
-            # print(f"Line: {line} has overlaps")
-            for overlap in line.get("overlaps"):
-                overlap_filename = get_clip_filename(overlap.get("speaker"),
-                                                     overlap.get('text'),
-                                                     output_dir)
-                try:
-                    print(f"Overlap filename: {overlap_filename}")
-                    overlap_clip = AudioSegment.from_file(
-                        file=overlap_filename)
-                except FileNotFoundError:
-                    print(f"Overlap audio clip not found: {overlap_filename}")
+            print(f"Overlap audio clip not found: {overlap_filename}")
+    return clip, overlaps
+
+
+def load_turns(dialogue: Iterable[Dict[str, Any]],
+               output_dir: str,
+               workers: int = DECODE_WORKERS) -> Iterator[Tuple[int, "Turn"]]:
+    """
+    Yield the index and decoded turn of each line of `dialogue` in order,
+    skipping missing clips. Turns are loaded a few ahead on a thread pool,
+    so clips that still need ffmpeg are decoded in parallel while earlier
+    turns are being mixed.
+    """
+    lines = iter(dialogue)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+
+        def submit_next():
+            line = next(lines, None)
+            if line is not None:
+                pending.append(pool.submit(load_turn, line, output_dir))
+
+        for _ in range(workers * 2):
+            submit_next()
+        index = 0
+        while pending:
+            turn = pending.popleft().result()
+            submit_next()
+            if turn is not None:
+                yield index, turn
+            index += 1
+
+
+def render_to_file(turns: Iterable["Turn"],
+                   output_file: str,
+                   output_format: Optional[str] = None):
+    """
+    Mix `turns` into `output_file` one turn at a time. Only the turn being
+    mixed and the last few milliseconds of the episode are held in memory,
+    however long the episode is. MP3 and Opus are encoded as they go.
+    """
+    from timeline import TimelineRenderer
+    from encoder import open_writer
+    renderer = TimelineRenderer()
+    with open_writer(output_file, output_format) as writer:
+        for clip, overlaps in turns:
+            writer.write(renderer.add(clip, overlaps))
+        writer.write(renderer.finish())
+
+
+def master_path(output_file: str) -> str:
+    """The PCM WAV kept next to a compressed episode for later edits."""
+    return os.path.splitext(output_file)[0] + ".wav"
+
+
+class EpisodeWriter:
+    """
+    Writes rendered audio to an episode file and records the renderer's
+    state after every turn, so a later edit can re-mix only the turns that
+    changed (see `rerender_episode`). Compressed episodes also get a WAV
+    master at `master_path`, to copy unchanged audio from.
+    """
+
+    def __init__(self,
+                 output_file: str,
+                 output_format: Optional[str] = None,
+                 renderer: Optional["TimelineRenderer"] = None):
+        from timeline import TimelineRenderer
+        from encoder import open_writer, output_format as format_of
+        output_format = output_format or format_of(output_file)
+        self.master_file = master_path(output_file)
+        self.renderer = renderer or TimelineRenderer()
+        self.writers = [open_writer(output_file, output_format)]
+        if output_format != "wav":
+            self.writers.append(open_writer(self.master_file, "wav"))
+        self.turns = []
+
+    def write(self, audio: "AudioSegment") -> "AudioSegment":
+        for writer in self.writers:
+            writer.write(audio)
+        return audio
+
+    def add(self, key: str, clip: "AudioSegment",
+            overlaps: List["AudioSegment"]) -> "AudioSegment":
+        """Mix the next turn and write the audio it made final."""
+        return self._record(key, self.renderer.add(clip, overlaps))
+
+    def splice(self, key: str, record: Dict[str, Any],
+               body: Any) -> Optional["AudioSegment"]:
+        """
+        Add a turn of an earlier render from its record and body (see
+        `TimelineRenderer.splice`); None if it has to be mixed again.
+        """
+        audio = self.renderer.splice(record, body)
+        return None if audio is None else self._record(key, audio)
+
+    def _record(self, key: str, audio: "AudioSegment") -> "AudioSegment":
+        self.write(audio)
+        self.turns.append({
+            **self.renderer.last_turn, "key": key,
+            "state": self.renderer.state()
+        })
+        return audio
+
+    def flush(self) -> "AudioSegment":
+        """Write the rest of the episode once every turn is added."""
+        return self.write(self.renderer.finish())
+
+    def copy(self, master_file: str, start: int, stop: int,
+             block: int = 1 << 18):
+        """Write frames `start` to `stop` of an earlier master unchanged."""
+        from pydub import AudioSegment
+        with wave.open(master_file, "rb") as wav:
+            wav.setpos(start)
+            for position in range(start, stop, block):
+                self.write(
+                    AudioSegment(data=wav.readframes(
+                        min(block, stop - position)),
+                                 sample_width=wav.getsampwidth(),
+                                 frame_rate=wav.getframerate(),
+                                 channels=wav.getnchannels()))
+
+    def close(self) -> Dict[str, Any]:
+        """Finish the files and return the record `rerender_episode` needs."""
+        for writer in self.writers:
+            writer.close()
+        return {
+            "master": os.path.basename(self.master_file),
+            "turns": self.turns
+        }
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+
+def join_audio_clips(dialogue: List[Dict[str, Any]],
+                     output_dir: str = "audio_clips",
+                     output_file: str = "final_output_1.wav",
+                     output_format: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Render the episode to `output_file`, in the format given by its extension
+    (wav, mp3 or opus) unless `output_format` is set. Returns the record
+    `rerender_episode` needs to re-render it after an edit.
+    """
+    from tqdm.auto import tqdm
+    keys = turn_keys(dialogue)
+    episode = EpisodeWriter(output_file, output_format)
+    try:
+        lines = tqdm(dialogue, desc="Joining audio clips", leave=False)
+        for index, turn in load_turns(lines, output_dir):
+            episode.add(keys[index], *turn)
+        episode.flush()
+    except BaseException:
+        episode.abort()
+        raise
+    return episode.close()
+
+
+def _shifted(turn: Dict[str, Any], delta: int) -> Dict[str, Any]:
+    state = turn["state"]
+    return {
+        **turn, "state": {
+            **state, "length": state["length"] + delta,
+            "base": state["base"] + delta
+        }
+    }
+
+
+def rerender_episode(dialogue: List[Dict[str, Any]],
+                     output_dir: str,
+                     output_file: str,
+                     previous: Dict[str, Any],
+                     output_format: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Render an edited `dialogue` to `output_file`, re-mixing only the parts
+    that differ from the earlier render described by `previous` (as returned
+    by `join_audio_clips`). Returns the record of the new render.
+
+    Turns are matched against the earlier ones by `turn_keys`, so a turn
+    counts as changed when its text or its previous_text context did. New
+    and changed turns are mixed; runs of unchanged turns are copied from
+    the earlier master. Where a run starts at a different position, its
+    turns are spliced in one by one from the earlier audio, re-mixing only
+    the crossfade into each, until the renderer is in the same state it was
+    in then. The result matches a full render sample for sample. Turns
+    recorded before splicing was supported are mixed again instead.
+    """
+    from timeline import TimelineRenderer, recorded_body, state_key
+    keys = turn_keys(dialogue)
+    old = previous["turns"]
+    master = os.path.join(os.path.dirname(output_file), previous["master"])
+    episode = EpisodeWriter(output_file, output_format)
+    mixed = 0
+
+    def mix(start, stop):
+        nonlocal mixed
+        for index, turn in load_turns(dialogue[start:stop], output_dir):
+            episode.add(keys[index + start], *turn)
+            mixed += 1
+
+    def splice(old_index, index, wav):
+        """Add turn `index` from earlier turn `old_index`, if it lines up."""
+        record = old[old_index]
+        if episode.renderer.format is None or "head" not in record:
+            return False
+
+        def read(start, stop):
+            wav.setpos(start)
+            return wav.readframes(stop - start)
+
+        previous_length = old[old_index -
+                              1]["state"]["length"] if old_index else 0
+        body = recorded_body(record, previous_length, record["state"], read)
+        return body is not None and episode.splice(keys[index], record,
+                                                   body) is not None
+
+    def converged(old_index):
+        """Whether the renderer is where the earlier one was after `old_index`."""
+        renderer = episode.renderer
+        if old_index < 0 or renderer.format is None:
+            return old_index < 0 and renderer.format is None
+        return state_key(renderer.state()) == state_key(
+            old[old_index]["state"])
+
+    def reuse(old_index, old_stop):
+        """Copy the earlier render from after `old_index` up to `old_stop`."""
+        start = old[old_index]["state"]["base"] if old_index >= 0 else 0
+        delta = episode.renderer.base - start
+        episode.copy(master, start, old[old_stop - 1]["state"]["base"])
+        episode.turns.extend(
+            _shifted(turn, delta) for turn in old[old_index + 1:old_stop])
+        episode.renderer = TimelineRenderer.restore(
+            episode.turns[-1]["state"])
+
+    matcher = difflib.SequenceMatcher(None, [turn["key"] for turn in old],
+                                      keys,
+                                      autojunk=False)
+    try:
+        with wave.open(master, "rb") as wav:
+            for tag, old_start, old_stop, start, stop in matcher.get_opcodes():
+                if tag != "equal":
+                    mix(start, stop)
                     continue
-                overlap_start_time = max(0, len(clip) - 850)
-                overlap_start_time = max(0, len(clip) - 850)
-                clip = clip.overlay(overlap_clip, position=overlap_start_time)
-                if len(overlap_clip) > 850:
-                    remaining_overlap = overlap_clip[850:]
-                    clip = clip.append(remaining_overlap, crossfade=0)
-        if len(clip) < 10 or len(output_audio) < 10:
-            crossfade_duration = 0
-        else:
-            crossfade_duration = min(10,
-                                     len(clip) // 2,
-                                     len(output_audio) // 2)
-        print(f"Crossfade duration: {crossfade_duration} ms")
-        output_audio = output_audio.append(clip, crossfade=crossfade_duration)
+                for old_index in range(old_start, old_stop):
+                    if converged(old_index - 1):
+                        reuse(old_index - 1, old_stop)
+                        break
+                    index = old_index - old_start + start
+                    if not splice(old_index, index, wav):
+                        mix(index, index + 1)
+        episode.flush()
+    except BaseException:
+        episode.abort()
+        raise
+    span = metrics.current_span()
+    span.add("turns_remixed", mixed)
+    span.add("turns_reused", len(keys) - mixed)
+    print(f"Re-mixed {mixed} of {len(keys)} turns")
+    return episode.close()
+
+
+class ProgressiveJoin:
+    """
+    Renders the episode while its clips are still being synthesized.
+
+    Pass `add_turn` as the `on_turn` callback of `generate_voice_clips_stream`.
+    Each time audio becomes final it is appended to `output_file` and written
+    as a numbered WAV chunk under `<output_dir>/stream`, whose path is handed
+    to `on_audio`. The finished file matches `join_audio_clips`; once it is
+    published the chunks are deleted. Call `abort` if the clips never
+    arrive.
+    """
+
+    def __init__(self,
+                 output_dir: str,
+                 output_file: str,
+                 on_audio: Optional[Callable[[str], None]] = None):
+        self.output_dir = output_dir
+        self.output_file = output_file
+        self.on_audio = on_audio or (lambda path: None)
+        self.chunk_dir = os.path.join(output_dir, "stream")
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self.episode = EpisodeWriter(output_file)
+        self.previous_text = None
+        self.chunks = 0
+
+    async def add_turn(self, line: Dict[str, Any]):
+        key, self.previous_text = _turn_key(line, self.previous_text)
+        turn = await asyncio.to_thread(load_turn, line, self.output_dir)
+        if turn is not None:
+            await self._publish(self.episode.add, key, *turn)
+
+    async def _publish(self, render, *args):
+        path = await asyncio.to_thread(self._write, render, *args)
+        if path is not None:
+            self.on_audio(path)
+
+    def _write(self, render, *args) -> Optional[str]:
+        audio = render(*args)
+        if not audio.raw_data:
+            return None
+        self.chunks += 1
+        path = os.path.join(self.chunk_dir, f"chunk_{self.chunks:04d}.wav")
+        audio.export(path, format="wav")
+        return path
+
+    async def finish(self) -> Dict[str, Any]:
+        """
+        Write the remaining audio and close `output_file`. Returns the
+        record `rerender_episode` needs, like `join_audio_clips`.
+        """
+        await self._publish(self.episode.flush)
+        record = await asyncio.to_thread(self.episode.close)
+        await asyncio.to_thread(self._remove_chunks)
+        return record
+
+    def abort(self):
+        """Discard the partly written episode and its chunks."""
+        self.episode.abort()
+        self._remove_chunks()
 
-    output_audio.export(output_file, format="wav")
+    def _remove_chunks(self):
+        for chunk in range(1, self.chunks + 1):
+            try:
+                os.remove(
+                    os.path.join(self.chunk_dir, f"chunk_{chunk:04d}.wav"))
+            except FileNotFoundError:
+                pass
 
 
 # Example usage